@@ -0,0 +1,151 @@
+"""
+A deterministic, in-process stand-in for the npri package's remote data, for benchmarks.
+
+install(facilities) patches npri.get_npri_data, npri.Places and npri.Facilities so the
+dashboards run against synthetic data of the given size without any network access.
+"""
+import re
+import numpy
+import pandas
+import geopandas
+import shapely
+from npri import npri
+
+SUBSTANCES = ["Carbon monoxide",
+            "Sulphur dioxide",
+            "Ammonia (total)",
+            "PM10 - Particulate Matter <= 10 Micrometers",
+            "PM2.5 - Particulate Matter <= 2.5 Micrometers",
+            "Nitrogen oxides (expressed as nitrogen dioxide)",
+            "Volatile Organic Compounds (Total)",
+            "Lead (and its compounds)",
+            "Mercury (and its compounds)",
+            "Benzene"
+            ]
+TIMES = ["Most Recent", "Past 5 Years", "Past 15 Years", "All Years"]
+PLACE_CIMD = ["Residential instability Scores", "Economic dependency Scores", "Ethno-cultural composition Scores", "Situational vulnerability Scores"]
+FACILITY_CIMD = ["median_instability_2021", "median_dependency_2021", "median_composition_2021", "median_vulnerability_2021"]
+INDUSTRIES = ["Oil and gas extraction", "Pulp, paper and paperboard mills", "Electric power generation", "Cement manufacturing", "Petroleum refineries", "Waste management", "Metal ore mining", "Chemical manufacturing"]
+DA_SIZE = 400 # Metres per side of a synthetic Dissemination Area
+DA_GRID = 15 # DAs per side of an FSA
+
+class Dataset():
+    """
+    Synthetic NPRI tables for a given number of facilities
+    facilities -- int: number of facilities
+    seed -- int: random seed, so runs are comparable across commits
+    """
+    def __init__(self, facilities=1000, seed=0):
+        rng = numpy.random.default_rng(seed)
+        self.fsas = ["{}{}{}".format(a, d, b) for a in "KLMN" for d in range(1, 10) for b in "ABCEGHJ"][:max(1, facilities // 25)]
+        ids = numpy.arange(1, facilities + 1)
+        fsa = rng.integers(0, len(self.fsas), facilities)
+        # Lay FSAs out on a grid of squares in EPSG:3347 and scatter facilities inside their FSA
+        self.origins = {name: (7000000 + (i % 40) * DA_SIZE * DA_GRID, 900000 + (i // 40) * DA_SIZE * DA_GRID) for i, name in enumerate(self.fsas)}
+        origin = numpy.array([self.origins[self.fsas[f]] for f in fsa])
+        x = origin[:, 0] + rng.uniform(0, DA_SIZE * DA_GRID, facilities)
+        y = origin[:, 1] + rng.uniform(0, DA_SIZE * DA_GRID, facilities)
+        self.exporter = pandas.DataFrame({
+            "NpriID": ids,
+            "ForwardSortationArea": numpy.array(self.fsas)[fsa],
+            "NAICSTitleEn": rng.choice(INDUSTRIES, facilities),
+            **{c: rng.uniform(1, 5, facilities).round(2) for c in FACILITY_CIMD},
+            "geom": shapely.to_wkb(shapely.points(x, y), hex=True),
+        })
+        # Each facility reports a few substances over a run of years
+        rows = []
+        for npri_id in ids:
+            first = rng.integers(1993, 2020)
+            for substance in rng.choice(SUBSTANCES, rng.integers(1, 4), replace=False):
+                years = numpy.arange(first, 2023)
+                rows.append(pandas.DataFrame({"NpriID": npri_id, "Substance": substance, "ReportYear": years, "SumInTonnes": rng.lognormal(0, 2, years.shape[0]).round(3)}))
+        self.reports = pandas.concat(rows, ignore_index=True)
+
+    def sql(self, sql):
+        """
+        Answer the handful of sql shapes the dashboards send
+        """
+        if 'distinct "Substance"' in sql:
+            return pandas.DataFrame({"Substance": self.reports["Substance"].unique()})
+        if 'distinct "ForwardSortationArea"' in sql:
+            return pandas.DataFrame({"ForwardSortationArea": self.exporter["ForwardSortationArea"].unique()})
+        if 'min("ReportYear")' in sql:
+            return pandas.DataFrame({"first": [self.reports["ReportYear"].min()], "last": [self.reports["ReportYear"].max()]})
+        if "npri_reports_full_table" in sql:
+            years = [int(y) for y in re.findall(r'"ReportYear" [<>]= (\d+)', sql)]
+            substances = re.findall(r"'((?:[^']|'')*)'", sql.split(" in (")[-1])
+            substances = [s.replace("''", "'") for s in substances]
+            mask = self.reports["ReportYear"].between(years[0], years[1]) & self.reports["Substance"].str.lower().isin(substances)
+            if '"NpriID" in (' in sql:
+                mask &= self.reports["NpriID"].isin([int(i) for i in re.findall(r"\d+", sql.split('"NpriID" in (')[1].split(")")[0])])
+            return self.reports.loc[mask].reset_index(drop=True)
+        if "npri_exporter_table" in sql:
+            columns = [c.strip().strip('"') for c in sql.split("select ")[1].split(" from")[0].split(",")]
+            frame = self.exporter
+            if " in (" in sql:
+                ids = [int(i) for i in re.findall(r"\d+", sql.split(" in (")[-1])]
+                frame = frame.loc[frame["NpriID"].isin(ids)]
+            return frame[columns].reset_index(drop=True)
+        return None
+
+    def places(self, fsa=None, ids=None):
+        """
+        A grid of DAs covering the FSA (or the FSAs of the given DAUIDs)
+        """
+        if ids is not None:
+            fsa = self.fsas[(ids[0] - 35000000) // (DA_GRID * DA_GRID)]
+        i = self.fsas.index(fsa)
+        x0, y0 = self.origins[fsa]
+        n = DA_GRID * DA_GRID
+        rng = numpy.random.default_rng(i)
+        geometry = [shapely.box(x0 + (k % DA_GRID) * DA_SIZE, y0 + (k // DA_GRID) * DA_SIZE, x0 + (k % DA_GRID + 1) * DA_SIZE, y0 + (k // DA_GRID + 1) * DA_SIZE) for k in range(n)]
+        data = {c: rng.uniform(-2, 3, n).round(3) for c in PLACE_CIMD}
+        data.update({s + " - Allocated": rng.lognormal(-2, 2, n).round(4) for s in SUBSTANCES})
+        return geopandas.GeoDataFrame(data, geometry=geometry, crs=3347, index=pandas.Index(numpy.arange(35000000 + i * n, 35000000 + (i + 1) * n), name="dauid"))
+
+    def facilities(self, dauids=None, ids=None):
+        """
+        Facilities within the given DAs (or with the given ids), with per-timeframe totals
+        """
+        if ids is None:
+            fsas = {self.fsas[(d - 35000000) // (DA_GRID * DA_GRID)] for d in dauids}
+            frame = self.exporter.loc[self.exporter["ForwardSortationArea"].isin(fsas)]
+        else:
+            frame = self.exporter.loc[self.exporter["NpriID"].isin(ids)]
+        reports = self.reports.loc[self.reports["NpriID"].isin(frame["NpriID"])]
+        data = pandas.DataFrame(index=pandas.Index(frame["NpriID"].to_numpy(), name="NpriID"))
+        data["NAICSTitleEn"] = frame["NAICSTitleEn"].to_numpy()
+        for time, first in zip(TIMES, [2022, 2018, 2008, 1993]):
+            totals = reports.loc[reports["ReportYear"] >= first].pivot_table(index="NpriID", columns="Substance", values="SumInTonnes", aggfunc="sum")
+            for substance in SUBSTANCES:
+                data[substance + " - " + time] = totals[substance].reindex(data.index) if substance in totals else numpy.nan
+        return geopandas.GeoDataFrame(data, geometry=geopandas.GeoSeries.from_wkb(frame["geom"].to_numpy()).values, crs=3347)
+
+def install(facilities=1000, seed=0):
+    """
+    Patch npri to serve a synthetic Dataset. Returns the dataset.
+    """
+    dataset = Dataset(facilities, seed)
+
+    def get_npri_data(view, endpoint, params=None, sql=None, index=None):
+        data = dataset.sql(sql) if endpoint == "sql" else None
+        return data, "fake://" + str(endpoint), None
+
+    class Places(npri.Places):
+        def __init__(self, ids=None, near=None, across=None, place=None):
+            self.index = "dauid"
+            self.data = dataset.places(fsa=place[0] if place else None, ids=ids)
+            self.working_data = self.data.copy()
+            self.features = {}
+
+    class Facilities(npri.Facilities):
+        def __init__(self, ids=None, near=None, place=None, across=None, substances=None, bounds=None, within=None, sql=None, attributes=None):
+            self.index = "NpriID"
+            self.data = dataset.facilities(dauids=within, ids=ids)
+            self.working_data = self.data.copy()
+            self.features = {}
+
+    npri.get_npri_data = get_npri_data
+    npri.Places = Places
+    npri.Facilities = Facilities
+    return dataset
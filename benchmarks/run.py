@@ -0,0 +1,143 @@
+"""
+Replay scripted Overview and Places interactions headlessly and report rerun latency,
+peak memory and payload size per step.
+
+    python -m benchmarks.run --facilities 100 1000 20000 --json results.json
+
+Runs against benchmarks.fake_npri, so no network access is needed and results are
+comparable across commits. Set NPRI_TILE_URL (e.g. http://localhost:8765) to include
+vector tiles, as in a deployment that serves them.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def isolate():
+    """
+    Keep runs independent of the machine's snapshot, query cache and network
+    """
+    directory = tempfile.mkdtemp(prefix="npri_bench_")
+    os.environ.pop("NPRI_SNAPSHOT", None)
+    os.environ["NPRI_CACHE_DIR"] = os.path.join(directory, "cache")
+    os.environ["NPRI_FSA_VISITS"] = os.path.join(directory, "visits.json")
+    os.environ["NPRI_HEALTH_CACHE"] = os.path.join(directory, "health.json")
+    os.environ["NPRI_HEALTH_RECORDED"] = os.path.join(directory, "recorded.json")
+    os.environ["NPRI_TILE_DIR"] = os.path.join(directory, "tiles")
+    with open(os.environ["NPRI_HEALTH_RECORDED"], "w") as f:
+        json.dump({"Carbon monoxide": 200, "Benzene": 200}, f)
+    sys.path.insert(0, ROOT)
+
+def payload(at):
+    """
+    Bytes of element protos the frontend would receive for the current page
+    """
+    size = 0
+    nodes = [at._tree]
+    while nodes:
+        node = nodes.pop()
+        proto = getattr(node, "proto", None)
+        if proto is not None:
+            size += proto.ByteSize()
+        nodes.extend(getattr(node, "children", {}).values())
+    return size
+
+def overview(at, dataset):
+    yield "load", lambda: at.switch_page("pages/Overview.py")
+    for substance in ["Volatile Organic Compounds (Total)", "Nitrogen oxides (expressed as nitrogen dioxide)", "Benzene"]:
+        yield "substance", lambda substance=substance: at.multiselect(key="substance").set_value([substance])
+    yield "compare", lambda: at.multiselect(key="substance").set_value(["Carbon monoxide", "Sulphur dioxide", "Ammonia (total)", "Volatile Organic Compounds (Total)", "Benzene"])
+    for years in [(2000, 2022), (2005, 2020), (2010, 2015), (2012, 2013), (1993, 2022)]:
+        yield "timeframe", lambda years=years: at.slider(key="time").set_value(years)
+    for share in [0.5, 0.1, 0.01]:
+        yield "tonnage", lambda share=share: narrow(at.slider[1], share)
+
+def places(at, dataset):
+    yield "load", lambda: at.switch_page("pages/Places.py")
+    for fsa in dataset.fsas[1:6]:
+        yield "fsa", lambda fsa=fsa: at.selectbox(key="fsa").set_value(fsa)
+    for share in [0.5, 0.1]:
+        yield "tonnage", lambda share=share: narrow(at.slider[0], share)
+    for indicator in ["Economic dependency Scores", "Ethno-cultural composition Scores", "Situational vulnerability Scores"]:
+        yield "indicator", lambda indicator=indicator: at.selectbox[-1].set_value(indicator)
+
+def narrow(slider, share):
+    """
+    Move a range slider to the bottom share of its range
+    """
+    low, high = slider.min, slider.max
+    return slider.set_value((low, low + (high - low) * share))
+
+SCENARIOS = {"overview": overview, "places": places}
+
+def run(name, facilities, timeout):
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+    from benchmarks import fake_npri
+    from dashboard import tiles
+    from dashboard import data
+    from dashboard.cache import queries
+    from dashboard.store import QueryStore
+    dataset = fake_npri.install(facilities)
+    st.cache_data.clear() # Caches are per process; don't carry data over from another run
+    st.cache_resource.clear()
+    queries.clear()
+    data.store = QueryStore(root=tempfile.mkdtemp(prefix="cache_", dir=os.environ["NPRI_CACHE_DIR"]))
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=timeout)
+    at.run()
+    steps = {}
+    tracemalloc.start()
+    for step, action in SCENARIOS[name](at, dataset):
+        action()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        at.run()
+        elapsed = time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(name + " " + step + ": " + at.exception[0].message)
+        result = steps.setdefault(step, {"latency": [], "peak": [], "payload": []})
+        result["latency"].append(elapsed)
+        result["peak"].append(tracemalloc.get_traced_memory()[1])
+        result["payload"].append(payload(at))
+    tracemalloc.stop()
+    # Release the tile server's port, or the next run's server couldn't bind it and would run without tiles
+    server = tiles.server()
+    if server is not None:
+        server.close()
+    return {step: {
+        "runs": len(r["latency"]),
+        "p50_ms": float(numpy.percentile(r["latency"], 50) * 1000),
+        "p90_ms": float(numpy.percentile(r["latency"], 90) * 1000),
+        "p99_ms": float(numpy.percentile(r["latency"], 99) * 1000),
+        "peak_mb": max(r["peak"]) / 1e6,
+        "payload_kb": max(r["payload"]) / 1e3,
+    } for step, r in steps.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--facilities", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+    isolate()
+
+    results = []
+    print("{:<10} {:>10} {:<10} {:>5} {:>9} {:>9} {:>9} {:>9} {:>11}".format("scenario", "facilities", "step", "runs", "p50 ms", "p90 ms", "p99 ms", "peak MB", "payload KB"))
+    for facilities in args.facilities:
+        for name in args.scenarios:
+            for step, r in run(name, facilities, args.timeout).items():
+                results.append({"scenario": name, "facilities": facilities, "step": step, **r})
+                print("{:<10} {:>10} {:<10} {:>5} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>11.1f}".format(name, facilities, step, r["runs"], r["p50_ms"], r["p90_ms"], r["p99_ms"], r["peak_mb"], r["payload_kb"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == "__main__":
+    main()
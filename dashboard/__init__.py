@@ -0,0 +1,3 @@
+"""
+Shared data and mapping helpers for the NPRI dashboard pages.
+"""
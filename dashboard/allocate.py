@@ -0,0 +1,68 @@
+"""
+Releases allocated across Census Dissemination Areas (DAs) within a radius of each facility.
+
+A facility's release is split among the DAs its circular buffer intersects, in
+proportion to the share of the buffer's area that falls in each DA. The facility x DA
+weights for a set of DAs and a radius are found once, with STRtrees and vectorized
+intersections, and kept as sparse (facility, DA, weight) triplets, so allocating any
+substance and timeframe is a single sparse matrix-vector product.
+"""
+import numpy
+import pandas
+import shapely
+
+RADII = [1, 2.5, 5, 10] # Buffer radii offered, in km
+RADIUS = 5 # As allocated upstream by npri
+QUAD_SEGS = 8 # Segments per quarter circle of a buffer
+
+class Locations():
+    """
+    Every facility's location in EPSG:3347 (metres) with an STRtree, to find the
+    facilities whose buffers can reach a set of DAs
+    frame -- DataFrame: NpriID and WKB geom in EPSG:3347, as in npri_exporter_table
+    """
+    def __init__(self, frame):
+        frame = frame.dropna(subset=["geom"]).drop_duplicates(subset="NpriID")
+        points = shapely.from_wkb(frame["geom"].to_numpy())
+        keep = ~shapely.is_empty(points)
+        self.ids = frame["NpriID"].to_numpy()[keep]
+        self.points = points[keep]
+        self.tree = shapely.STRtree(self.points)
+
+    def near(self, geometries, distance):
+        """
+        Positions of the facilities within distance metres of any of geometries
+        """
+        return numpy.unique(self.tree.query(geometries, predicate="dwithin", distance=distance)[1])
+
+class Allocation():
+    """
+    Sparse facility x DA weights for a set of DAs and a buffer radius
+    locations -- Locations
+    places -- GeoDataFrame: DA polygons indexed by dauid
+    radius -- float: buffer radius in km
+    """
+    def __init__(self, locations, places, radius=RADIUS):
+        self.radius = radius
+        self.dauids = places.index.to_numpy()
+        das = places.geometry.to_crs(3347).to_numpy()
+        distance = radius * 1000
+        near = locations.near(das, distance)
+        self.ids = locations.ids[near]
+        buffers = shapely.buffer(locations.points[near], distance, quad_segs=QUAD_SEGS)
+        facility, da = shapely.STRtree(das).query(buffers, predicate="intersects")
+        areas = shapely.area(shapely.intersection(buffers[facility], das[da]))
+        keep = areas > 0
+        self.rows = facility[keep]
+        self.columns = da[keep]
+        self.weights = areas[keep] / shapely.area(buffers)[self.rows]
+
+    def allocate(self, releases):
+        """
+        Each DA's share of the releases of the facilities around it
+        releases -- Series: tonnes indexed by NpriID; facilities not in it release nothing
+        Returns a Series indexed by dauid, in the order of places
+        """
+        values = releases.reindex(self.ids).fillna(0).to_numpy(dtype="float64")
+        allocated = numpy.bincount(self.columns, weights=self.weights * values[self.rows], minlength=self.dauids.shape[0])
+        return pandas.Series(allocated, index=pandas.Index(self.dauids, name="dauid"))
@@ -0,0 +1,128 @@
+"""
+A bounded, process-wide cache for query results.
+
+Entries are measured in bytes and evicted least-recently-used first once the budget is
+exceeded, or when they are older than the TTL. Concurrent misses for the same key are
+fetched once. Besides query results it holds what is built from them, e.g. Overview's
+ReleaseCubes, so one budget bounds both.
+
+NPRI_CACHE_MB -- memory budget in megabytes (default 256)
+NPRI_CACHE_TTL -- seconds an entry stays valid (default one hour)
+"""
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import pandas
+
+BUDGET = int(float(os.environ.get("NPRI_CACHE_MB", 256)) * 1e6)
+TTL = float(os.environ.get("NPRI_CACHE_TTL", 60 * 60))
+
+def size(value):
+    """
+    Approximate bytes held by a cached value
+    """
+    if isinstance(value, (pandas.DataFrame, pandas.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pandas.DataFrame) else int(value.memory_usage(deep=True))
+    if hasattr(value, "nbytes"): # numpy arrays, and objects built on them like ReleaseCube
+        return int(value.nbytes)
+    return sys.getsizeof(value)
+
+class QueryCache():
+    """
+    budget -- int: bytes to hold at most
+    ttl -- float: seconds before an entry expires
+    """
+    def __init__(self, budget=BUDGET, ttl=TTL):
+        self.budget = budget
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (value, bytes, expires)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.version = None
+        self.pending = {} # key -> Future, for fetches in progress
+        self.lock = threading.RLock()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries), "bytes": self.bytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def use(self, version):
+        """
+        Drop every entry when the data version changes, i.e. a new snapshot was swapped in
+        version -- str or None: the version answering queries (data.refresh())
+        """
+        with self.lock:
+            if version != self.version:
+                self.clear()
+                self.version = version
+
+    def _drop(self, key):
+        value, nbytes, expires = self.entries.pop(key)
+        self.bytes -= nbytes
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.time():
+            self._drop(key)
+            self.evictions += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def get(self, key, fetch):
+        """
+        The cached value for key, or fetch() (which is then cached)
+        key -- hashable
+        fetch -- callable returning the value
+        """
+        with self.lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            pending = self.pending.get(key)
+            fetching = pending is None
+            if fetching:
+                self.misses += 1
+                pending = self.pending[key] = Future()
+        if not fetching: # Another thread is already fetching it
+            return pending.result()
+        try:
+            value = fetch()
+            self.put(key, value)
+            pending.set_result(value)
+            return value
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def put(self, key, value):
+        if value is None:
+            return
+        nbytes = size(value)
+        if nbytes > self.budget:
+            return # Would evict everything else
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (value, nbytes, time.time() + self.ttl)
+            self.bytes += nbytes
+            while self.bytes > self.budget:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+queries = QueryCache()
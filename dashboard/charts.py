@@ -0,0 +1,50 @@
+"""
+Chart data prepared on the server at the resolution a chart actually draws, so the
+browser gets a few rows per bar or bin instead of every facility or Dissemination Area.
+"""
+import numpy
+import pandas
+
+OTHER = "Other"
+SCATTER_POINTS = 500 # Above this many points, scatter plots are binned
+BINS = 30 # Bins per axis for a binned scatter plot
+
+def top(frame, label, value="SumInTonnes", n=10, other=OTHER):
+    """
+    Rows for the n labels with the largest totals, with every other row summed into one
+    other label (per Substance when the frame has a Substance column)
+    frame -- DataFrame: label and value columns, and optionally Substance
+    Returns the rows and the order to draw labels in: largest first, other last
+    """
+    keys = ["Substance"] if "Substance" in frame.columns else []
+    totals = frame.groupby(label, observed=True)[value].sum()
+    kept = totals.nlargest(n).index
+    order = [str(l) for l in kept]
+    shown = frame.loc[frame[label].isin(kept), [label] + keys + [value]]
+    rest = frame.loc[~frame[label].isin(kept)]
+    if rest.shape[0] > 0:
+        if keys:
+            rest = rest.groupby(keys, observed=True)[[value]].sum().reset_index()
+        else:
+            rest = pandas.DataFrame({value: [rest[value].sum()]})
+        rest[label] = other
+        shown = pandas.concat([shown.astype({label: str}), rest], ignore_index=True)
+        order.append(other)
+    return shown.astype({label: str}), order
+
+def scatter(frame, x, y, points=SCATTER_POINTS, bins=BINS):
+    """
+    x, y pairs with a count column: the points themselves (count 1) when there are few,
+    otherwise the centre and number of points of each non-empty cell of a bins x bins grid
+    frame -- DataFrame: x and y columns
+    """
+    frame = frame[[x, y]].dropna()
+    if frame.shape[0] <= points:
+        return frame.assign(count=1).reset_index(drop=True)
+    counts, xedges, yedges = numpy.histogram2d(frame[x].to_numpy(), frame[y].to_numpy(), bins=bins)
+    xs, ys = numpy.nonzero(counts)
+    return pandas.DataFrame({
+        x: (xedges[xs] + xedges[xs + 1]) / 2,
+        y: (yedges[ys] + yedges[ys + 1]) / 2,
+        "count": counts[xs, ys].astype(int),
+    })
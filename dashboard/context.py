@@ -0,0 +1,36 @@
+"""
+Facility context (industry, deprivation scores, location) for every NPRI facility.
+"""
+import numpy
+import pandas
+import geopandas
+from dashboard.data import CIMD
+
+class FacilityContext():
+    """
+    The npri_exporter_table context columns for all facilities, loaded once and held as
+    arrays sorted by NpriID, with geometry decoded to latitude/longitude up front
+    frame -- DataFrame: NpriID, NAICSTitleEn, the CIMD medians and WKB geom
+    """
+    def __init__(self, frame):
+        frame = frame.drop_duplicates(subset="NpriID").sort_values(by="NpriID")
+        self.ids = frame["NpriID"].to_numpy()
+        points = geopandas.GeoSeries.from_wkb(frame["geom"], crs=3347).to_crs(4326)
+        missing = points.isna() | points.is_empty
+        self.table = pandas.DataFrame({
+            "NAICSTitleEn": frame["NAICSTitleEn"].to_numpy(),
+            **{metric: frame[metric].to_numpy() for metric in CIMD},
+            "latitude": numpy.where(missing, numpy.nan, points.y.where(~missing)),
+            "longitude": numpy.where(missing, numpy.nan, points.x.where(~missing)),
+        }, index=pandas.Index(self.ids, name="NpriID"))
+
+    def lookup(self, ids):
+        """
+        Context rows for the given NpriIDs, in the same order; unknown ids are left out
+        ids -- array-like: NpriIDs
+        """
+        ids = numpy.asarray(ids)
+        positions = numpy.searchsorted(self.ids, ids)
+        positions[positions >= self.ids.shape[0]] = 0
+        found = self.ids[positions] == ids if self.ids.shape[0] > 0 else numpy.zeros(ids.shape, dtype=bool)
+        return self.table.iloc[positions[found]]
@@ -0,0 +1,102 @@
+"""
+Pre-aggregated releases for the Overview timeframe slider.
+"""
+import numpy
+import pandas
+
+class ReleaseCube():
+    """
+    Releases of one or more substances held as substance x facility x year arrays of running
+    totals, so the total for any range of years is one subtraction per facility instead of a
+    fetch and groupby, for every substance at once.
+    records -- DataFrame: NpriID, Substance, ReportYear, SumInTonnes rows for every year
+    first, last -- int: first and last ReportYear covered
+    """
+    def __init__(self, records, first=1993, last=2022):
+        self.first = first
+        self.last = last
+        layers, substances = pandas.factorize(records["Substance"], sort=True)
+        self.substances = [str(substance) for substance in substances]
+        self.ids = numpy.sort(records["NpriID"].unique())
+        rows = numpy.searchsorted(self.ids, records["NpriID"].to_numpy())
+        cols = records["ReportYear"].to_numpy().astype(int) - first + 1 # column 0 is "before first"
+        shape = (len(self.substances), self.ids.shape[0], last - first + 2)
+        tonnes = numpy.zeros(shape)
+        reports = numpy.zeros(shape, dtype=numpy.int32)
+        numpy.add.at(tonnes, (layers, rows, cols), records["SumInTonnes"].fillna(0).to_numpy())
+        numpy.add.at(reports, (layers, rows, cols), 1)
+        self.tonnes = tonnes.cumsum(axis=2)
+        self.reports = reports.cumsum(axis=2)
+
+    @property
+    def nbytes(self):
+        return self.tonnes.nbytes + self.reports.nbytes + self.ids.nbytes
+
+    def window(self, years):
+        """
+        Column positions bounding a (start, end) range of years
+        """
+        start = max(years[0], self.first) - self.first
+        end = min(years[1], self.last) - self.first + 1
+        return start, end
+
+    def layers(self, frame):
+        """
+        Positions in self.substances of a frame's Substance column
+        """
+        return pandas.Categorical(frame["Substance"], categories=self.substances).codes
+
+    def totals(self, years):
+        """
+        Total releases per facility and substance for facilities that reported in the range
+        of years, like records.groupby(["NpriID", "Substance"]).sum()
+        years -- tuple: first and last ReportYear, inclusive
+        """
+        start, end = self.window(years)
+        reported = (self.reports[:, :, end] - self.reports[:, :, start]) > 0
+        layers, rows = numpy.nonzero(reported)
+        totals = pandas.DataFrame({
+            "NpriID": self.ids[rows],
+            "Substance": pandas.Categorical.from_codes(layers, categories=self.substances),
+            "SumInTonnes": self.tonnes[layers, rows, end] - self.tonnes[layers, rows, start]
+        })
+        return totals.set_index("NpriID")
+
+    def industries(self, totals, naics):
+        """
+        Total releases per industry and substance for the facilities in totals
+        totals -- DataFrame: output of totals(), possibly filtered
+        naics -- Series: NAICSTitleEn indexed by NpriID
+        """
+        naics = naics[~naics.index.duplicated()]
+        titles = naics.reindex(totals.index).to_numpy()
+        codes, labels = pandas.factorize(titles)
+        found = codes >= 0
+        keys = self.layers(totals)[found] * len(labels) + codes[found]
+        shape = (len(self.substances), len(labels))
+        sums = numpy.bincount(keys, weights=totals["SumInTonnes"].to_numpy()[found], minlength=shape[0] * shape[1]).reshape(shape)
+        counts = numpy.bincount(keys, minlength=shape[0] * shape[1]).reshape(shape)
+        layers, industries = numpy.nonzero(counts)
+        ind = pandas.DataFrame({
+            "NAICSTitleEn": numpy.asarray(labels)[industries],
+            "Substance": pandas.Categorical.from_codes(layers, categories=self.substances),
+            "SumInTonnes": sums[layers, industries]
+        })
+        return ind.set_index("NAICSTitleEn")
+
+    def yearly(self, years, totals):
+        """
+        Total releases per ReportYear and substance across the facilities in totals
+        years -- tuple: first and last ReportYear, inclusive
+        totals -- DataFrame: output of totals(), possibly filtered
+        """
+        start, end = self.window(years)
+        layers = self.layers(totals)
+        rows = numpy.searchsorted(self.ids, totals.index.to_numpy())
+        sums = numpy.zeros((len(self.substances), end - start))
+        numpy.add.at(sums, layers, numpy.diff(self.tonnes[layers, rows, start:end+1], axis=1))
+        return pandas.DataFrame({
+            "ReportYear": numpy.tile(numpy.arange(start, end) + self.first, len(self.substances)),
+            "Substance": numpy.repeat(self.substances, end - start),
+            "SumInTonnes": sums.ravel()
+        })
@@ -0,0 +1,263 @@
+"""
+Data access for the NPRI dashboards.
+
+Queries are answered in-process from a local snapshot of npri_reports_full_table
+and npri_exporter_table when one is configured, and from the remote npri sql
+endpoint otherwise (or whenever the snapshot can't answer a query).
+
+Set NPRI_SNAPSHOT to a directory holding reports.parquet and exporter.parquet
+(and, optionally, fsa.parquet) to use a snapshot. Build one with:
+
+    python -m dashboard.data snapshot <directory>
+
+or point it at a versioned snapshot kept up to date by dashboard.ingest, whose CURRENT
+file names the version in use; pages switch to a new version on their next rerun.
+"""
+import os
+import sys
+import json
+import threading
+import pandas
+from npri import npri
+from dashboard.store import store
+
+REPORTS = "reports.parquet"
+EXPORTER = "exporter.parquet"
+PARTITIONS = "reports" # Directory of one reports file per ReportYear, in ingested versions
+MANIFEST = "manifest.json"
+CURRENT = "CURRENT"
+VERSIONS = "versions"
+YEARS = (1993, 2022) # Without a snapshot to say otherwise
+FSA = "fsa.parquet"
+
+CATEGORIES = ["Substance", "NAICSTitleEn", "ForwardSortationArea"]
+IDS = ["NpriID", "dauid"]
+CIMD = ["median_instability_2021", "median_dependency_2021", "median_composition_2021", "median_vulnerability_2021"]
+CONTEXT = ["NpriID", "NAICSTitleEn"] + CIMD + ["geom"]
+
+def quote(values):
+    """
+    Build the body of a sql in (...) clause
+    values -- list: strings or numbers
+    """
+    return ",".join("'" + str(v).replace("'", "''") + "'" if isinstance(v, str) else str(v) for v in values)
+
+def compact(frame):
+    """
+    Shrink a frame's dtypes in place: repeated names become categoricals, years int16,
+    ids int32 and other floats float32. Column names and values are unchanged.
+    frame -- DataFrame or GeoDataFrame (other values are returned as is)
+    """
+    if not isinstance(frame, pandas.DataFrame):
+        return frame
+    for column in frame.columns:
+        series = frame[column]
+        if column in CATEGORIES and (pandas.api.types.is_object_dtype(series) or pandas.api.types.is_string_dtype(series)):
+            frame[column] = series.astype("category")
+        elif column == "ReportYear" and pandas.api.types.is_integer_dtype(series):
+            frame[column] = series.astype("int16")
+        elif column in IDS and pandas.api.types.is_integer_dtype(series) and series.shape[0] > 0 and series.max() < 2**31:
+            frame[column] = series.astype("int32")
+        elif series.dtype == "float64":
+            frame[column] = series.astype("float32")
+    if frame.index.name in IDS and pandas.api.types.is_integer_dtype(frame.index) and frame.shape[0] > 0 and frame.index.max() < 2**31:
+        frame.index = frame.index.astype("int32")
+    return frame
+
+class RemoteBackend():
+    """
+    Answers queries with hand-built sql sent to the npri sql endpoint
+    """
+    def sql(self, sql):
+        data, url, report_url = npri.get_npri_data(view=None, endpoint="sql", sql=sql)
+        return data
+
+    def substances(self):
+        return self.sql('select distinct "Substance" from npri_reports_full_table;')
+
+    def years(self):
+        return self.sql('select min("ReportYear") as first, max("ReportYear") as last from npri_reports_full_table;')
+
+    def records(self, substances, years, ids=None):
+        facilities = '"NpriID" in ({}) and '.format(quote(ids)) if ids is not None else ''
+        return self.sql('select "NpriID", "Substance", "ReportYear", "SumInTonnes" from npri_reports_full_table where '+facilities+'"ReportYear" >= '+str(years[0])+' and "ReportYear" <= '+str(years[1])+' and lower("Substance") in ({})'.format(quote([s.lower() for s in substances])))
+
+    def context(self, ids, columns=CONTEXT):
+        columns = ", ".join('"'+c+'"' if c != "geom" else c for c in columns)
+        if ids is None:
+            return self.sql('select {} from npri_exporter_table;'.format(columns))
+        return self.sql('select {} from npri_exporter_table where "NpriID" in ({});'.format(columns, quote(ids)))
+
+    def fsas(self):
+        return self.sql('select distinct "ForwardSortationArea" from npri_exporter_table;')
+
+    def reports(self, year=None):
+        """
+        Every row of npri_reports_full_table the dashboards use, or one ReportYear's
+        """
+        where = ' where "ReportYear" = '+str(int(year)) if year is not None else ''
+        return self.sql('select "NpriID", "Substance", "ReportYear", "SumInTonnes" from npri_reports_full_table'+where+';')
+
+    def exporter(self):
+        """
+        Every facility's npri_exporter_table columns the dashboards use
+        """
+        return self.sql('select "NpriID", "ForwardSortationArea", "NAICSTitleEn", {}, geom from npri_exporter_table;'.format(", ".join('"'+c+'"' for c in CIMD)))
+
+    def fsa(self, fsa):
+        return self.sql('select * from from lfsa.... where X = \''+fsa+'\';') # FSA shapes are not in the db yet
+
+class LocalBackend():
+    """
+    Answers the same queries as RemoteBackend from a Parquet snapshot held in memory
+    path -- str: snapshot directory
+    """
+    def __init__(self, path):
+        self.path = path
+        self.version = os.path.basename(os.path.normpath(path))
+        reports = os.path.join(path, PARTITIONS) if os.path.isdir(os.path.join(path, PARTITIONS)) else os.path.join(path, REPORTS)
+        self.reports = compact(pandas.read_parquet(reports, columns=["NpriID", "Substance", "ReportYear", "SumInTonnes"]))
+        self.exporter = compact(pandas.read_parquet(os.path.join(path, EXPORTER)))
+        self.substance_keys = self.reports["Substance"].str.lower()
+        try:
+            with open(os.path.join(path, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def substances(self):
+        return pandas.DataFrame({"Substance": self.reports["Substance"].unique()})
+
+    def years(self):
+        first, last = self.manifest.get("years") or (self.reports["ReportYear"].min(), self.reports["ReportYear"].max())
+        return pandas.DataFrame({"first": [int(first)], "last": [int(last)]})
+
+    def records(self, substances, years, ids=None):
+        mask = (self.reports["ReportYear"] >= years[0]) & (self.reports["ReportYear"] <= years[1]) & self.substance_keys.isin([s.lower() for s in substances])
+        if ids is not None:
+            mask &= self.reports["NpriID"].isin(ids)
+        return self.reports.loc[mask].reset_index(drop=True)
+
+    def context(self, ids, columns=CONTEXT):
+        if ids is None:
+            return self.exporter[columns].copy()
+        return self.exporter.loc[self.exporter["NpriID"].isin(ids), columns].reset_index(drop=True)
+
+    def fsas(self):
+        return pandas.DataFrame({"ForwardSortationArea": self.exporter["ForwardSortationArea"].dropna().unique()})
+
+    def fsa(self, fsa):
+        shapes = pandas.read_parquet(os.path.join(self.path, FSA))
+        return shapes.loc[shapes["ForwardSortationArea"] == fsa].reset_index(drop=True)
+
+def current():
+    """
+    The snapshot directory in use: the version named by NPRI_SNAPSHOT's CURRENT file, or
+    NPRI_SNAPSHOT itself for a snapshot that isn't versioned; None without a snapshot
+    """
+    root = os.environ.get("NPRI_SNAPSHOT")
+    if not root:
+        return None
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            return os.path.join(root, VERSIONS, f.read().strip())
+    except OSError:
+        return root
+
+remote = RemoteBackend()
+local = None
+failed = None # A version that couldn't be loaded, so it isn't retried every rerun
+lock = threading.Lock()
+
+def refresh():
+    """
+    Load the snapshot in use, switching to a new version once one has been swapped in
+    (the previous version keeps answering if the new one can't be loaded).
+    Returns the version answering queries, or None when queries go to the remote endpoint
+    """
+    global local, failed
+    path = current()
+    if path is None or path == failed:
+        return local.version if local is not None else None
+    if local is None or local.path != path:
+        with lock:
+            if local is None or local.path != path:
+                try:
+                    local = LocalBackend(path)
+                except Exception as e:
+                    failed = path
+                    print("Couldn't load snapshot, using the remote endpoint: ", e)
+    return local.version if local is not None else None
+
+refresh()
+
+def query(name, *args, **kwargs):
+    """
+    Run a named query against the local snapshot, falling back to the shared on-disk
+    cache of remote results and then the remote endpoint
+    name -- str: a RemoteBackend/LocalBackend method, e.g. "records"
+    """
+    if local is not None:
+        try:
+            return getattr(local, name)(*args, **kwargs)
+        except Exception as e:
+            print("Snapshot couldn't answer "+name+", using the remote endpoint: ", e)
+    key = list(args) + sorted(kwargs.items())
+    if store is not None:
+        cached = store.get(name, key)
+        if cached is not None:
+            return compact(cached)
+    result = getattr(remote, name)(*args, **kwargs)
+    if store is not None:
+        store.put(name, key, result)
+    return compact(result)
+
+def substances():
+    return query("substances")
+
+def years():
+    """
+    First and last ReportYear in the data
+    """
+    frame = query("years")
+    return int(frame["first"].iloc[0]), int(frame["last"].iloc[0])
+
+def records(substances, years, ids=None):
+    """
+    substances -- list: substance names (case insensitive)
+    years -- tuple: first and last ReportYear, inclusive
+    ids -- list: NpriIDs to limit the records to, or None for every facility (not empty)
+    """
+    if ids is None:
+        return query("records", substances, years)
+    return query("records", substances, years, ids)
+
+def context(ids, columns=CONTEXT):
+    """
+    ids -- list: NpriIDs, or None for every facility
+    columns -- list: npri_exporter_table columns to return
+    """
+    return query("context", ids, columns)
+
+def fsas():
+    return query("fsas")
+
+def fsa(fsa):
+    return query("fsa", fsa)
+
+def snapshot(path):
+    """
+    Copy the tables the dashboards use from the remote endpoint into a local snapshot
+    path -- str: directory to write to
+    """
+    os.makedirs(path, exist_ok=True)
+    reports = remote.reports()
+    reports.to_parquet(os.path.join(path, REPORTS), index=False)
+    exporter = remote.exporter()
+    exporter.to_parquet(os.path.join(path, EXPORTER), index=False)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "snapshot":
+        snapshot(sys.argv[2])
+    else:
+        print("usage: python -m dashboard.data snapshot <directory>")
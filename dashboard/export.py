@@ -0,0 +1,80 @@
+"""
+Downloads of the rows behind a page's current selection.
+
+Rows are selected, joined to their context and written a chunk at a time into a
+temporary file when the download is clicked, so an export never holds a combined
+copy of the selection (or a second copy of a national one) in memory.
+
+NPRI_EXPORT_ROWS -- rows per chunk (default 50000)
+"""
+import os
+import re
+import tempfile
+import numpy
+import pandas
+import geopandas
+import pyarrow
+import pyarrow.parquet
+
+CHUNK = int(os.environ.get("NPRI_EXPORT_ROWS", 50000))
+FORMATS = {"CSV": ("csv", "text/csv"), "Parquet": ("parquet", "application/vnd.apache.parquet")}
+
+def name(parts, extension):
+    """
+    A file name safe on any system from the parts of a selection
+    parts -- list: e.g. substances and years
+    """
+    return re.sub(r"[^\w.-]+", "_", "_".join(str(part) for part in parts)).strip("_") + "." + extension
+
+def chunks(frame, mask=None, columns=None, join=None, constants=None, coordinates=False, chunk=CHUNK):
+    """
+    The rows of frame passing mask, chunk rows at a time, with the index as a column.
+    Always yields at least one (possibly empty) chunk, so files get their columns.
+    frame -- DataFrame or GeoDataFrame, treated as read-only
+    mask -- boolean array over frame's rows, or None for every row
+    columns -- list: columns to keep, or None for all but geometry
+    join -- DataFrame joined to each chunk on the index, e.g. facility context
+    constants -- dict: columns added to every row, e.g. the selection's FSA or years
+    coordinates -- bool: add latitude and longitude of frame's point geometry
+    """
+    positions = numpy.flatnonzero(mask) if mask is not None else numpy.arange(frame.shape[0])
+    if columns is None:
+        columns = [c for c in frame.columns if not isinstance(frame[c].dtype, geopandas.array.GeometryDtype)]
+    located = coordinates and isinstance(frame, geopandas.GeoDataFrame)
+    indexer = frame.columns.get_indexer(columns)
+    for start in range(0, max(positions.shape[0], 1), chunk):
+        rows = positions[start:start + chunk]
+        selected = pandas.DataFrame(frame.iloc[rows, indexer])
+        if located:
+            points = frame.geometry.iloc[rows].to_crs(4326)
+            selected["latitude"] = points.y.to_numpy()
+            selected["longitude"] = points.x.to_numpy()
+        if join is not None:
+            selected = selected.join(join, how="left")
+        for column, value in (constants or {}).items():
+            selected[column] = value
+        yield selected.reset_index()
+
+def write(chunks, extension):
+    """
+    Write chunks to a temporary file, returned open at its start (it is deleted on close)
+    chunks -- iterable of DataFrames with the same columns
+    extension -- str: "csv" or "parquet", as in FORMATS
+    """
+    f = tempfile.TemporaryFile()
+    if extension == "csv":
+        header = True
+        for rows in chunks:
+            rows.to_csv(f, header=header, index=False)
+            header = False
+    else:
+        writer = None
+        for rows in chunks:
+            table = pyarrow.Table.from_pandas(rows, preserve_index=False)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(f, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        if writer is not None:
+            writer.close()
+    f.seek(0)
+    return f
@@ -0,0 +1,98 @@
+"""
+Runs a page's data fetches concurrently.
+
+Each page declares its fetches with the fetches they depend on. A fetch starts on a
+thread as soon as the last of its inputs is ready, so independent fetches overlap and
+the page waits about as long as its slowest chain instead of the sum of every fetch.
+Threads belong to one rerun of one session, so a session waiting on a slow fetch never
+holds up another's, and they exit once the rerun's fetches are done.
+
+NPRI_FETCH_WORKERS -- threads per rerun at most (default 8)
+"""
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+WORKERS = int(os.environ.get("NPRI_FETCH_WORKERS", 8))
+
+class Fetches():
+    """
+    A dependency graph of named fetches for one rerun of a page
+    workers -- int: threads to run fetches on at most
+    """
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.pool = None # Started with the first fetch, shut down when none are left
+        self.running = 0
+        self.context = get_script_run_ctx() # Lets cached functions run on the pool threads
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.waiting = {}
+        self.timings = {}
+
+    def add(self, name, function, after=()):
+        """
+        Declare a fetch and start it once its inputs are ready
+        name -- str: used by get() and by later fetches' after
+        function -- called with the results of after, in order
+        after -- list: names of fetches added earlier
+        """
+        for dependency in after:
+            if dependency not in self.steps:
+                raise KeyError("Unknown fetch: " + dependency)
+        with self.lock:
+            self.steps[name] = (function, list(after), Future())
+            self.waiting[name] = set(dependency for dependency in after if not self.steps[dependency][2].done())
+            ready = not self.waiting[name]
+        if ready:
+            self.start(name)
+        return self
+
+    def start(self, name):
+        function, after, future = self.steps[name]
+        def call():
+            if self.context is not None: # The thread is this rerun's alone, so it's never detached
+                add_script_run_ctx(ctx=self.context)
+            began = time.perf_counter()
+            try:
+                return function(*[self.steps[dependency][2].result() for dependency in after])
+            finally:
+                self.timings[name] = round((time.perf_counter() - began) * 1000, 2)
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fetch")
+            self.running += 1
+            submitted = self.pool.submit(call)
+        submitted.add_done_callback(lambda done: self.finish(name, done))
+
+    def finish(self, name, done):
+        future = self.steps[name][2]
+        if done.exception() is not None:
+            future.set_exception(done.exception())
+        else:
+            future.set_result(done.result())
+        # Start the fetches this one was the last input of
+        ready = []
+        with self.lock:
+            self.running -= 1
+            for other, waiting in self.waiting.items():
+                if name in waiting:
+                    waiting.discard(name)
+                    if not waiting:
+                        ready.append(other)
+            if not ready and self.running == 0: # Let the threads exit; a later add() starts new ones
+                self.pool.shutdown(wait=False)
+                self.pool = None
+        for other in ready:
+            self.start(other)
+
+    def __contains__(self, name):
+        return name in self.steps
+
+    def get(self, name):
+        """
+        Wait for a fetch and return its result (raises what the fetch raised)
+        """
+        return self.steps[name][2].result()
@@ -0,0 +1,125 @@
+"""
+Links to Health Canada's "chemicals at a glance" fact sheets.
+
+Whether a substance has a fact sheet is checked in the background and kept in a
+persistent cache, so pages never wait on the government web server to render.
+
+NPRI_HEALTH_CACHE -- file to keep results in between restarts
+NPRI_HEALTH_TTL -- seconds before a result is checked again (default one week)
+NPRI_HEALTH_RECORDED -- json file of {substance: status code} to use instead of the network, e.g. offline
+"""
+import os
+import json
+import time
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import streamlit as st
+
+BASE = "https://www.canada.ca/en/health-canada/services/chemical-substances/fact-sheets/chemicals-glance/"
+CACHE = os.environ.get("NPRI_HEALTH_CACHE", os.path.join(tempfile.gettempdir(), "npri_health.json"))
+TTL = float(os.environ.get("NPRI_HEALTH_TTL", 7 * 24 * 60 * 60))
+RETRY = 10 * 60 # Check again sooner when the site couldn't be reached
+
+def url(substance):
+    return BASE + "{}.html".format(substance.lower().replace(" ", "-"))
+
+class HealthLinks():
+    """
+    Resolves substance -> fact sheet status codes on a thread pool
+    path -- str: json file to persist results to
+    ttl -- float: seconds a result stays fresh
+    recorded -- dict: substance -> status code to use instead of requesting the page
+    """
+    def __init__(self, path=CACHE, ttl=TTL, recorded=None, workers=4):
+        self.path = path
+        self.ttl = ttl
+        self.recorded = recorded
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="health")
+        self.results = {}
+        try:
+            with open(path) as f:
+                self.results = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def fresh(self, substance):
+        result = self.results.get(substance)
+        if result is None:
+            return False
+        ttl = self.ttl if result["status"] else RETRY
+        return time.time() - result["checked"] < ttl
+
+    def check(self, substance):
+        if self.recorded is not None:
+            status = self.recorded.get(substance, 404)
+        else:
+            try:
+                status = requests.get(url(substance), timeout=10).status_code
+            except requests.RequestException:
+                status = 0 # Unreachable
+        with self.lock:
+            self.results[substance] = {"status": status, "checked": time.time()}
+            self.pending.discard(substance)
+        self.save()
+
+    def submit(self, substance):
+        with self.lock:
+            if substance in self.pending or self.fresh(substance):
+                return
+            self.pending.add(substance)
+        self.pool.submit(self.check, substance)
+
+    def warm(self, substances):
+        """
+        Queue checks for every substance that isn't already known
+        """
+        for substance in substances:
+            self.submit(substance)
+
+    def lookup(self, substance):
+        """
+        True if there is a fact sheet, False if not, None if it hasn't been checked yet.
+        Never blocks; stale or unknown substances are re-checked in the background.
+        """
+        self.submit(substance)
+        result = self.results.get(substance)
+        if result is None or result["status"] == 0:
+            return None
+        return result["status"] == 200
+
+    def save(self):
+        with self.lock:
+            results = dict(self.results)
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+                json.dump(results, f)
+            os.replace(f.name, self.path)
+        except OSError as e:
+            print("Couldn't save health links: ", e)
+
+@st.cache_resource
+def resolver():
+    """
+    One resolver per process, shared by every session
+    """
+    recorded = None
+    if os.environ.get("NPRI_HEALTH_RECORDED"):
+        with open(os.environ["NPRI_HEALTH_RECORDED"]) as f:
+            recorded = json.load(f)
+    return HealthLinks(recorded=recorded)
+
+def message(substance):
+    """
+    The text pages show about a substance's health effects
+    """
+    found = resolver().lookup(substance)
+    if found:
+        return "Learn more about "+substance+" here: "+ url(substance)
+    if found is None:
+        return "Checking for information about the health effects of "+substance+". In the meantime, try searching: "+BASE
+    return "Unable to retrieve information about the health effects of "+substance+" at this time. Try searching: "+BASE
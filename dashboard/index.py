@@ -0,0 +1,235 @@
+"""
+A precomputed FSA -> DAUID/NpriID index and background warm-up of per-FSA data.
+
+Build the index into a snapshot directory from Statistics Canada's 2021 Dissemination
+Area and Forward Sortation Area boundary files:
+
+    python -m dashboard.index <snapshot> <lda_000b21a_e.shp> <lfsa000b21a_e.shp> [cimd.csv]
+
+This also stores the boundaries in the snapshot as places.parquet and fsa.parquet. Given
+the 2021 CIMD scores by DA, places.parquet also carries them for the national tile layer.
+"""
+import os
+import sys
+import json
+import threading
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pandas
+import geopandas
+import shapely
+from npri import npri
+from dashboard.data import EXPORTER, FSA, compact, current
+
+PLACES = "places.parquet"
+FSA_DAUIDS = "fsa_dauids.parquet"
+FSA_FACILITIES = "fsa_facilities.parquet"
+SCORES = ["Residential instability Scores", "Economic dependency Scores", "Ethno-cultural composition Scores", "Situational vulnerability Scores"]
+VISITS = os.environ.get("NPRI_FSA_VISITS", os.path.join(tempfile.gettempdir(), "npri_fsa_visits.json"))
+WARM = int(os.environ.get("NPRI_WARM_FSAS", 50)) # How many of the most-visited FSAs to keep ready
+RECENT = int(os.environ.get("NPRI_RECENT_FSAS", 20)) # How many other visited FSAs to keep, least recently visited dropped first
+
+def build(path, da_file, fsa_file, cimd_file=None):
+    """
+    Intersect every FSA with the DAs and every facility with the DAs, using STRtrees
+    path -- str: snapshot directory (with exporter.parquet)
+    da_file, fsa_file -- str: boundary files readable by geopandas
+    cimd_file -- str: optional csv of DAUID and the CIMD score columns
+    """
+    das = geopandas.read_file(da_file).to_crs(3347)
+    fsas = geopandas.read_file(fsa_file).to_crs(3347)
+    das = das.rename(columns={"DAUID": "dauid"})[["dauid", "geometry"]]
+    das["dauid"] = das["dauid"].astype("int64")
+    fsas = fsas.rename(columns={"CFSAUID": "ForwardSortationArea"})[["ForwardSortationArea", "geometry"]]
+
+    tree = shapely.STRtree(das.geometry.values)
+    fsa_idx, da_idx = tree.query(fsas.geometry.values, predicate="intersects")
+    fsa_dauids = pandas.DataFrame({
+        "ForwardSortationArea": fsas["ForwardSortationArea"].to_numpy()[fsa_idx],
+        "dauid": das["dauid"].to_numpy()[da_idx],
+    })
+
+    exporter = pandas.read_parquet(os.path.join(path, EXPORTER), columns=["NpriID", "geom"])
+    fsa_facilities = locate(exporter, tree, das["dauid"].to_numpy(), fsa_dauids)
+
+    fsa_dauids.to_parquet(os.path.join(path, FSA_DAUIDS), index=False)
+    fsa_facilities.to_parquet(os.path.join(path, FSA_FACILITIES), index=False)
+    places = pandas.DataFrame({"dauid": das["dauid"], "geom": shapely.to_wkb(das.geometry.values)})
+    if cimd_file is not None:
+        scores = pandas.read_csv(cimd_file).rename(columns={"DAUID": "dauid"})
+        scores = scores[["dauid"] + [score for score in SCORES if score in scores.columns]]
+        places = places.merge(scores.astype({"dauid": "int64"}), on="dauid", how="left")
+    places.to_parquet(os.path.join(path, PLACES), index=False)
+    pandas.DataFrame({"ForwardSortationArea": fsas["ForwardSortationArea"], "geom": shapely.to_wkb(fsas.geometry.values)}).to_parquet(os.path.join(path, FSA), index=False)
+
+def locate(exporter, tree, dauids, fsa_dauids):
+    """
+    The FSAs of each facility, through the DA it is within
+    exporter -- DataFrame: NpriID and WKB geom
+    tree -- STRtree of DA polygons; dauids -- array: their DAUIDs, in the same order
+    """
+    exporter = exporter.dropna(subset=["geom"])
+    points = geopandas.GeoSeries.from_wkb(exporter["geom"], crs=3347)
+    point_idx, da_idx = tree.query(points.values, predicate="within")
+    facility_das = pandas.DataFrame({"NpriID": exporter["NpriID"].to_numpy()[point_idx], "dauid": dauids[da_idx]})
+    return fsa_dauids.merge(facility_das, on="dauid")[["ForwardSortationArea", "NpriID"]].drop_duplicates()
+
+def update(path, previous, ids):
+    """
+    Bring a new snapshot version's facility index up to date for the facilities whose
+    exporter rows changed, reusing every other facility's FSAs from the previous version
+    path -- str: new snapshot version, with exporter.parquet and the previous version's other index files
+    previous -- str: the version it replaces
+    ids -- list: NpriIDs added, changed or removed
+    """
+    facilities = pandas.read_parquet(os.path.join(previous, FSA_FACILITIES))
+    facilities = facilities.loc[~facilities["NpriID"].isin(ids)]
+    exporter = pandas.read_parquet(os.path.join(path, EXPORTER), columns=["NpriID", "geom"])
+    exporter = exporter.loc[exporter["NpriID"].isin(ids)]
+    if exporter.shape[0] > 0:
+        places = pandas.read_parquet(os.path.join(path, PLACES), columns=["dauid", "geom"])
+        tree = shapely.STRtree(shapely.from_wkb(places["geom"].to_numpy()))
+        fsa_dauids = pandas.read_parquet(os.path.join(path, FSA_DAUIDS))
+        facilities = pandas.concat([facilities, locate(exporter, tree, places["dauid"].to_numpy(), fsa_dauids)], ignore_index=True)
+    # Replace rather than overwrite: the file may be a hard link into the previous version
+    with tempfile.NamedTemporaryFile(dir=path, suffix=".tmp", delete=False) as f:
+        facilities.to_parquet(f, index=False)
+    os.replace(f.name, os.path.join(path, FSA_FACILITIES))
+
+class FSAIndex():
+    """
+    FSA -> DAUIDs and FSA -> NpriIDs, loaded from a snapshot
+    path -- str: snapshot directory
+    """
+    def __init__(self, path):
+        dauids = pandas.read_parquet(os.path.join(path, FSA_DAUIDS))
+        facilities = pandas.read_parquet(os.path.join(path, FSA_FACILITIES))
+        self.dauids = {fsa: group.tolist() for fsa, group in dauids.groupby("ForwardSortationArea")["dauid"]}
+        self.facilities = {fsa: group.tolist() for fsa, group in facilities.groupby("ForwardSortationArea")["NpriID"]}
+
+    @classmethod
+    def load(cls):
+        """
+        The index in the snapshot in use, or None if there isn't one
+        """
+        path = current()
+        if path is None:
+            return None
+        try:
+            return cls(path)
+        except Exception as e:
+            print("Couldn't load the FSA index: ", e)
+            return None
+
+class FSABundles():
+    """
+    npri.Places and npri.Facilities for each FSA, loaded on a worker pool.
+    With an index, both are fetched by id at once instead of one spatial lookup after another.
+    Warmed FSAs stay loaded; of the others, only the recent most recently visited are kept.
+    index -- FSAIndex or None
+    recent -- int: visited FSAs kept besides the warmed ones
+    """
+    def __init__(self, index=None, workers=4, recent=RECENT):
+        self.index = index
+        self.recent = max(1, recent)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fsa")
+        self.fetches = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fsa-places") # Separate pool so loads never wait on themselves
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.warmed = set()
+        self.visited = OrderedDict() # Visited FSAs that weren't warmed, least recent first
+        try:
+            with open(VISITS) as f:
+                self.visits = json.load(f)
+        except (OSError, ValueError):
+            self.visits = {}
+
+    def fetch(self, fsa):
+        if self.index is not None and fsa in self.index.dauids:
+            places = self.fetches.submit(npri.Places, ids=self.index.dauids[fsa])
+            if self.index.facilities.get(fsa):
+                facilities = npri.Facilities(ids=self.index.facilities[fsa])
+            else:
+                facilities = npri.Facilities(within=self.index.dauids[fsa])
+            return places.result(), facilities
+        places = npri.Places(place=[fsa])
+        facilities = npri.Facilities(within=list(places.data.index.unique()))
+        return places, facilities
+
+    def load(self, fsa):
+        places, facilities = self.fetch(fsa)
+        for bundle in (places, facilities):
+            compact(bundle.data)
+            bundle.working_data = bundle.data # Shared read-only; FilteredView never writes to it
+        return places, facilities
+
+    def submit(self, fsa):
+        with self.lock:
+            if fsa not in self.futures:
+                self.futures[fsa] = self.pool.submit(self.load, fsa)
+            return self.futures[fsa]
+
+    def warm(self, fsas, limit=WARM):
+        """
+        Queue the most-visited FSAs for loading
+        fsas -- list: every FSA
+        """
+        ranked = sorted(fsas, key=lambda fsa: self.visits.get(fsa, 0), reverse=True)
+        for fsa in ranked[:limit]:
+            with self.lock:
+                self.warmed.add(fsa)
+                self.visited.pop(fsa, None)
+            self.submit(fsa)
+
+    def loaded(self, fsa):
+        """
+        Whether the FSA is already loaded, i.e. get() won't wait
+        """
+        future = self.futures.get(fsa)
+        return future is not None and future.done() and future.exception() is None
+
+    def save(self):
+        """
+        Write the visit counts for the next process to warm by, atomically since every
+        process on the node shares the file
+        """
+        with self.lock:
+            visits = dict(self.visits)
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(VISITS)), suffix=".tmp", delete=False) as f:
+                json.dump(visits, f)
+            os.replace(f.name, VISITS)
+        except OSError as e:
+            print("Couldn't save FSA visits: ", e)
+
+    def get(self, fsa):
+        """
+        (places, facilities) for the FSA, waiting for it if it isn't loaded yet
+        """
+        with self.lock:
+            self.visits[fsa] = self.visits.get(fsa, 0) + 1
+            missed = fsa not in self.futures
+            if fsa not in self.warmed:
+                self.visited[fsa] = None
+                self.visited.move_to_end(fsa)
+                while len(self.visited) > self.recent:
+                    evicted = self.visited.popitem(last=False)[0]
+                    future = self.futures.pop(evicted, None)
+                    if future is not None:
+                        future.cancel()
+        if missed: # Counts are only for ranking, so they're saved when a load is needed anyway
+            self.save()
+        future = self.submit(fsa)
+        try:
+            return future.result()
+        except Exception:
+            with self.lock: # Let the next visit try again
+                self.futures.pop(fsa, None)
+            raise
+
+if __name__ == "__main__":
+    if len(sys.argv) in (4, 5):
+        build(*sys.argv[1:])
+    else:
+        print("usage: python -m dashboard.index <snapshot> <da boundaries> <fsa boundaries> [cimd scores csv]")
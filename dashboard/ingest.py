@@ -0,0 +1,210 @@
+"""
+Incremental ingestion of NPRI data into a versioned local snapshot.
+
+    python -m dashboard.ingest <root> [<flat snapshot to read instead of the remote endpoint>]
+
+<root> holds versions/<version>/ directories and a CURRENT file naming the one in use;
+point NPRI_SNAPSHOT at <root>. Each run reads the reports one ReportYear at a time, and
+the facilities table, and compares content hashes with the current version. Years whose
+rows are unchanged are hard-linked from the current version instead of written again,
+and the FSA facility index is only updated for facilities that changed. CURRENT is then
+replaced atomically, so running pages switch to the new version on their next rerun.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import pandas
+from dashboard import data
+from dashboard import index
+from dashboard.data import REPORTS, EXPORTER, PARTITIONS, MANIFEST, CURRENT, VERSIONS
+
+HASHES = "exporter_hashes.parquet" # NpriID -> hash of the facility's exporter row
+DERIVED = [index.PLACES, data.FSA, index.FSA_DAUIDS, index.FSA_FACILITIES]
+KEEP = 3 # Versions kept, the current one included, for pages still reading the previous
+
+class RemoteSource():
+    """
+    Reads from the npri sql endpoint
+    """
+    def years(self):
+        first, last = data.remote.years().iloc[0]
+        return list(range(int(first), int(last) + 1))
+
+    def reports(self, year):
+        return data.remote.reports(year)
+
+    def exporter(self):
+        return data.remote.exporter()
+
+    def derived(self, name):
+        return None
+
+class ParquetSource():
+    """
+    Reads from a flat snapshot written by `python -m dashboard.data snapshot` (and
+    `python -m dashboard.index`), e.g. to move it to a versioned one
+    path -- str: snapshot directory
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def years(self):
+        years = pandas.read_parquet(os.path.join(self.path, REPORTS), columns=["ReportYear"])["ReportYear"]
+        return sorted(int(year) for year in years.unique())
+
+    def reports(self, year):
+        return pandas.read_parquet(os.path.join(self.path, REPORTS), filters=[("ReportYear", "==", year)])
+
+    def exporter(self):
+        return pandas.read_parquet(os.path.join(self.path, EXPORTER))
+
+    def derived(self, name):
+        path = os.path.join(self.path, name)
+        return path if os.path.exists(path) else None
+
+def digest(frame):
+    return hashlib.sha1(pandas.util.hash_pandas_object(frame, index=False).to_numpy().tobytes()).hexdigest()
+
+def reports(frame):
+    """
+    One year's reports in a canonical order and dtypes, so equal content hashes equal
+    """
+    frame = frame[["NpriID", "Substance", "ReportYear", "SumInTonnes"]].astype({"NpriID": "int64", "Substance": str, "ReportYear": "int64", "SumInTonnes": "float64"})
+    return frame.sort_values(by=["NpriID", "Substance"], kind="stable").reset_index(drop=True)
+
+def facility_hashes(frame):
+    """
+    A hash per NpriID of the rows in frame
+    """
+    hashes = pandas.util.hash_pandas_object(frame, index=False)
+    return pandas.DataFrame({"NpriID": frame["NpriID"].to_numpy(), "hash": hashes.to_numpy()}).groupby("NpriID")["hash"].sum() # uint64, wraps
+
+def changed(new, old):
+    """
+    NpriIDs whose hashes differ between two facility_hashes() results, including added and removed ones
+    """
+    both = pandas.concat([new.rename("new"), old.rename("old")], axis=1)
+    return both.index[both["new"].isna() | both["old"].isna() | (both["new"] != both["old"])].tolist()
+
+def link(source, target):
+    """
+    Reuse a file from the previous version without copying it where the filesystem allows
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def ingest(root, source):
+    """
+    Write a new version of the snapshot in root from source and make it current
+    root -- str: versioned snapshot directory
+    source -- RemoteSource or ParquetSource
+    Returns the new version, or None when nothing changed
+    """
+    versions = os.path.join(root, VERSIONS)
+    os.makedirs(versions, exist_ok=True)
+    previous, before = None, {}
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            previous = os.path.join(versions, f.read().strip())
+        with open(os.path.join(previous, MANIFEST)) as f:
+            before = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+    version = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    while os.path.exists(os.path.join(versions, version)):
+        version += "-1"
+    staging = tempfile.mkdtemp(dir=versions, prefix="." + version + "-")
+    os.makedirs(os.path.join(staging, PARTITIONS))
+
+    ## Reports, one ReportYear at a time
+    partitions, years_changed, reported = {}, [], set()
+    years = source.years()
+    for year in years:
+        frame = reports(source.reports(year))
+        partitions[str(year)] = {"hash": digest(frame), "rows": int(frame.shape[0])}
+        target = os.path.join(staging, PARTITIONS, str(year) + ".parquet")
+        old = before.get("partitions", {}).get(str(year))
+        if old is not None and old["hash"] == partitions[str(year)]["hash"]:
+            link(os.path.join(previous, PARTITIONS, str(year) + ".parquet"), target)
+            continue
+        frame.to_parquet(target, index=False)
+        years_changed.append(year)
+        if old is not None:
+            reported.update(changed(facility_hashes(frame), facility_hashes(pandas.read_parquet(os.path.join(previous, PARTITIONS, str(year) + ".parquet")))))
+        else:
+            reported.update(frame["NpriID"].unique().tolist())
+    years_removed = [int(year) for year in before.get("partitions", {}) if int(year) not in years]
+
+    ## Facilities
+    exporter = source.exporter().sort_values(by="NpriID", kind="stable").reset_index(drop=True)
+    hashes = facility_hashes(exporter)
+    try:
+        facilities = changed(hashes, pandas.read_parquet(os.path.join(previous, HASHES)).set_index("NpriID")["hash"])
+    except (OSError, ValueError, TypeError):
+        facilities = None # Everything is new
+    if previous is not None and facilities == []:
+        link(os.path.join(previous, EXPORTER), os.path.join(staging, EXPORTER))
+    else:
+        exporter.to_parquet(os.path.join(staging, EXPORTER), index=False)
+    hashes.reset_index().to_parquet(os.path.join(staging, HASHES), index=False)
+
+    if previous is not None and not years_changed and not years_removed and facilities == []:
+        shutil.rmtree(staging, ignore_errors=True)
+        print("Snapshot is up to date:", os.path.basename(previous))
+        return None
+
+    ## Derived files: carried over, with the facility index updated for changed facilities only
+    for name in DERIVED:
+        origin = os.path.join(previous, name) if previous is not None and os.path.exists(os.path.join(previous, name)) else source.derived(name)
+        if origin is not None:
+            link(origin, os.path.join(staging, name))
+    if previous is not None and facilities and all(os.path.exists(os.path.join(staging, name)) for name in [index.PLACES, index.FSA_DAUIDS, index.FSA_FACILITIES]):
+        index.update(staging, previous, facilities)
+
+    manifest = {
+        "version": version,
+        "previous": os.path.basename(previous) if previous is not None else None,
+        "years": [min(years), max(years)] if years else None,
+        "partitions": partitions,
+        "exporter": {"hash": digest(exporter), "rows": int(exporter.shape[0])},
+        "changed": {
+            "years": years_changed,
+            "removed_years": years_removed,
+            "reported": sorted(int(i) for i in reported),
+            "facilities": sorted(int(i) for i in facilities) if facilities is not None else None,
+        },
+    }
+    with open(os.path.join(staging, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+
+    ## Swap it in
+    os.chmod(staging, 0o755) # mkdtemp makes it 0700, which app processes running as another user can't read
+    os.rename(staging, os.path.join(versions, version))
+    with tempfile.NamedTemporaryFile("w", dir=root, suffix=".tmp", delete=False) as f:
+        f.write(version)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, os.path.join(root, CURRENT))
+    prune(versions, version)
+    print("Snapshot version", version, "- years rewritten:", years_changed or "none", "- facilities changed:", len(facilities) if facilities is not None else "all")
+    return version
+
+def prune(versions, version):
+    """
+    Remove all but the KEEP newest versions
+    """
+    names = sorted(name for name in os.listdir(versions) if not name.startswith("."))
+    for name in names[:-KEEP]:
+        if name != version:
+            shutil.rmtree(os.path.join(versions, name), ignore_errors=True)
+
+if __name__ == "__main__":
+    if len(sys.argv) in (2, 3):
+        ingest(sys.argv[1], ParquetSource(sys.argv[2]) if len(sys.argv) == 3 else RemoteSource())
+    else:
+        print("usage: python -m dashboard.ingest <root> [flat snapshot]")
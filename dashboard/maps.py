@@ -0,0 +1,121 @@
+"""
+Map layers for the dashboards, built from columns as single GeoJSON layers
+rather than one folium object per feature.
+"""
+import numpy
+import pandas
+import shapely
+import folium
+
+MAX_POINTS = 3000 # Above this many facilities, group nearby facilities for the national view
+CELL = 0.5 # Size of a grouping cell, in degrees
+PALETTE = ["#FFA500", "#1F77B4", "#2CA02C", "#D62728", "#9467BD", "#8C564B", "#E377C2", "#17BECF"] # One per substance when comparing
+
+def radius(values):
+    """
+    Marker radius by quartile of values, like the original per-marker sizing
+    """
+    quantile = pandas.qcut(values, 4, labels=False, duplicates="drop") # duplicates drop to handle single facility
+    quantile = pandas.Series(quantile, index=values.index).fillna(3) # Default marker size
+    return (quantile * 5) + 3
+
+def decimate(frame, attribute, cell=CELL):
+    """
+    Group facilities into grid cells, summing attribute, so a national map draws one marker per cell
+    frame -- DataFrame: latitude, longitude and attribute columns
+    """
+    keys = pandas.DataFrame({
+        "row": numpy.floor(frame["latitude"].to_numpy() / cell),
+        "col": numpy.floor(frame["longitude"].to_numpy() / cell),
+    })
+    cells = pandas.DataFrame({
+        "latitude": frame["latitude"].to_numpy(),
+        "longitude": frame["longitude"].to_numpy(),
+        attribute: frame[attribute].to_numpy(),
+        "Facilities": 1,
+    }).groupby([keys["row"], keys["col"]]).agg(
+        latitude=("latitude", "mean"), longitude=("longitude", "mean"), total=(attribute, "sum"), Facilities=("Facilities", "sum")
+    )
+    return cells.rename(columns={"total": attribute}).reset_index(drop=True)
+
+def feature_collection(frame, properties):
+    """
+    A GeoJSON point FeatureCollection from latitude/longitude columns
+    frame -- DataFrame: latitude, longitude and the properties columns
+    properties -- list: columns to carry as feature properties
+    """
+    props = frame[properties].round(4).astype(object).where(frame[properties].notna(), None).to_dict("records")
+    return {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": p}
+        for lon, lat, p in zip(frame["longitude"].tolist(), frame["latitude"].tolist(), props)
+    ]}
+
+def facility_layer(frame, attribute, fields, name="Facilities", color="#FFA500", max_points=MAX_POINTS):
+    """
+    One GeoJson layer of circle markers sized by quartile of attribute, with a shared popup template
+    frame -- DataFrame: facilities indexed by NpriID with latitude, longitude, attribute and fields columns
+    attribute -- str: column to size markers by
+    fields -- dict: column -> popup label
+    max_points -- int: above this many facilities, facilities are grouped into grid cells
+    """
+    frame = frame.loc[frame["latitude"].notna() & frame["longitude"].notna()]
+    if frame.shape[0] > max_points:
+        frame = decimate(frame, attribute)
+        fields = {"Facilities": "Facilities in this area", attribute: fields.get(attribute, attribute)}
+    else:
+        frame = frame.reset_index()
+    frame = frame.assign(radius=radius(frame[attribute]))
+    # Make larger markers appear in the back so as to not obscure small markers
+    frame = frame.sort_values(by="radius", ascending=False, kind="stable")
+    return folium.GeoJson(
+        feature_collection(frame, list(fields) + ["radius"]),
+        name=name,
+        marker=folium.CircleMarker(fill_color=color, weight=.5, fill_opacity=0.75),
+        style_function=lambda feature: {"radius": feature["properties"]["radius"]},
+        popup=folium.GeoJsonPopup(fields=list(fields), aliases=list(fields.values()), localize=True),
+    )
+
+SCALE = {0: "yellow", 1: "orange", 2: "red", 3: "brown"} # Same quartile colours as npri's choropleths
+TOLERANCE = 20 # Metres; finer than a pixel at the Places map's zoom
+
+class PlaceGeometry():
+    """
+    Dissemination Area polygons for one FSA, simplified and projected once so that
+    restyling by a different indicator only swaps the values attached to them
+    data -- GeoDataFrame: npri.Places data in EPSG:3347, indexed by dauid
+    tolerance -- float: simplification tolerance in metres
+    """
+    def __init__(self, data, tolerance=TOLERANCE):
+        geometry = data.geometry.copy()
+        present = (geometry.notna() & ~geometry.is_empty).to_numpy()
+        try:
+            # The DAs as one coverage, so edges neighbours share are simplified the same way
+            geometry[present] = shapely.coverage_simplify(geometry[present].to_numpy(), tolerance)
+        except Exception: # e.g. polygons that overlap rather than tile the FSA
+            geometry = geometry.simplify(tolerance, preserve_topology=True)
+        geometry = geometry.to_crs(4326)
+        self.ids = data.index.tolist()
+        self.geometries = [g.__geo_interface__ if g is not None else None for g in geometry]
+        minx, miny, maxx, maxy = geometry.total_bounds.tolist()
+        self.bounds = [[miny, minx], [maxy, maxx]]
+        self.center = ((miny + maxy) / 2, (minx + maxx) / 2)
+
+    def layer(self, values, mask, attribute):
+        """
+        A choropleth of the DAs in mask, shaded by quartile of values
+        values -- array-like: attribute values in the same order as the DAs
+        mask -- boolean array: which DAs to draw
+        attribute -- str: name to show in the tooltip
+        """
+        values = pandas.Series(numpy.asarray(values, dtype=float))[numpy.asarray(mask, dtype=bool)]
+        quantile = pandas.qcut(values, 4, labels=False, duplicates="drop")
+        fills = quantile.map(SCALE).fillna("white")
+        features = [
+            {"type": "Feature", "geometry": self.geometries[i], "properties": {"dauid": self.ids[i], attribute: None if numpy.isnan(v) else round(v, 4), "fill": fill}}
+            for i, v, fill in zip(values.index.tolist(), values.tolist(), fills.tolist()) if self.geometries[i] is not None
+        ]
+        return folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            style_function=lambda feature: {"fillColor": feature["properties"]["fill"], "fillOpacity": 0.7, "lineOpacity": .2, "weight": .2, "color": "black"},
+            tooltip=folium.GeoJsonTooltip(fields=["dauid", attribute], localize=True, sticky=False, labels=True, max_width=800),
+        )
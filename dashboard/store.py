@@ -0,0 +1,108 @@
+"""
+A file-backed cache of remote query results, shared by every process on a node and
+kept across restarts.
+
+Results are Parquet files named by a hash of the normalized query, in a directory per
+data version, so replicas pointed at the same NPRI_CACHE_DIR reuse each other's fetches
+and a new NPRI_DATA_VERSION starts from an empty cache. A result older than
+NPRI_CACHE_MAX_AGE is fetched again, so data the endpoint updates in place without a new
+version is picked up.
+
+NPRI_CACHE_DIR -- cache directory (default npri_cache in the temporary directory)
+NPRI_DATA_VERSION -- data version (default "remote")
+NPRI_CACHE_MAX_AGE -- seconds a result is served for (default 86400)
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import pandas
+
+CACHE_DIR = os.environ.get("NPRI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "npri_cache"))
+VERSION = os.environ.get("NPRI_DATA_VERSION", "remote")
+MAX_AGE = float(os.environ.get("NPRI_CACHE_MAX_AGE", 24 * 60 * 60)) # Seconds since a result was written before it's fetched again
+STALE = 7 * 24 * 60 * 60 # Seconds since another version's results were last written before they're removed
+
+def normalize(value):
+    """
+    A stable, json-able form of a query argument: lists are sorted, strings lowercased
+    """
+    if isinstance(value, (list, tuple, set)) or hasattr(value, "tolist"):
+        values = value.tolist() if hasattr(value, "tolist") else list(value)
+        if isinstance(value, tuple): # Ranges keep their order
+            return [normalize(v) for v in values]
+        return sorted((normalize(v) for v in values), key=str)
+    if isinstance(value, str):
+        return value.lower()
+    return value
+
+class QueryStore():
+    """
+    root -- str: cache directory, shared between processes
+    version -- str: data snapshot version; results from other versions are never read
+    max_age -- float: seconds a result is served for after it was written
+    """
+    def __init__(self, root=CACHE_DIR, version=VERSION, max_age=MAX_AGE):
+        self.directory = os.path.join(root, version)
+        self.max_age = max_age
+        os.makedirs(self.directory, exist_ok=True)
+        self.prune(root, version)
+
+    def prune(self, root, version, stale=STALE):
+        """
+        Remove results cached for other data versions that nothing has written to for a
+        while; replicas still on a version during a rolling deploy keep writing to it
+        """
+        for name in os.listdir(root):
+            directory = os.path.join(root, name)
+            try:
+                if name != version and os.path.isdir(directory) and time.time() - os.path.getmtime(directory) > stale:
+                    shutil.rmtree(directory, ignore_errors=True)
+            except OSError:
+                pass
+
+    def path(self, name, args):
+        key = json.dumps([name, normalize(list(args))], default=str)
+        return os.path.join(self.directory, name + "-" + hashlib.sha256(key.encode()).hexdigest()[:32] + ".parquet")
+
+    def get(self, name, args):
+        """
+        The cached result, or None if there's none or it has expired; put() replaces it
+        """
+        path = self.path(name, args)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            return pandas.read_parquet(path)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, name, args, frame):
+        """
+        Write a result atomically: readers see either the whole file or no file
+        """
+        if not isinstance(frame, pandas.DataFrame):
+            return
+        path = self.path(name, args)
+        temporary = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                frame.to_parquet(f, index=False)
+            os.replace(temporary, path)
+        except Exception as e: # A result that can't be cached is still returned
+            print("Couldn't cache "+name+": ", e)
+            try:
+                if temporary is not None and os.path.exists(temporary):
+                    os.remove(temporary)
+            except OSError:
+                pass
+
+store = None
+try:
+    store = QueryStore()
+except OSError as e:
+    print("Query cache is unavailable: ", e)
@@ -0,0 +1,293 @@
+"""
+Vector tiles (MVT) for map layers too large to send through st_folium as GeoJSON.
+
+Layers are registered with a tile server running in the app's process. The map then
+requests only the tiles in view, each generalized for its zoom level and cached on
+disk by the layer's content hash, so a nationwide layer costs about as much as a local one.
+
+Opt-in: tiles are only served when NPRI_TILE_URL says where browsers can reach the
+server (e.g. http://localhost:8765, or a path a reverse proxy forwards to NPRI_TILE_PORT),
+since a deployment may expose only the app's own port. It also needs the optional
+mapbox-vector-tile package. Otherwise pages keep their GeoJSON layers.
+
+NPRI_TILE_PORT -- port to serve tiles on (default 8765)
+NPRI_TILE_URL -- address browsers reach the tile server at; unset turns tiles off
+NPRI_TILE_DIR -- directory to cache tiles in, owned by one app process
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy
+import pandas
+import geopandas
+import shapely
+import streamlit as st
+from folium.plugins import VectorGridProtobuf
+from dashboard.maps import radius, SCALE
+from dashboard.data import current
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+PORT = int(os.environ.get("NPRI_TILE_PORT", 8765))
+URL = os.environ.get("NPRI_TILE_URL")
+DIRECTORY = os.environ.get("NPRI_TILE_DIR", os.path.join(tempfile.gettempdir(), "npri_tiles"))
+PLACES = "places.parquet"
+WORLD = 20037508.342789244 # Half the width of the web mercator plane, in metres
+EXTENT = 4096 # Tile coordinate resolution
+DETAIL = 12 # From this zoom on, every point is drawn
+SPACING = 4 # Below DETAIL, pixels between the points kept
+SOURCES = 64 # Registered layers kept in memory and on disk, besides pinned ones
+PATH = re.compile(r"^/(\w+)/(\d+)/(\d+)/(\d+)\.pbf$")
+
+def bounds(z, x, y):
+    """
+    Web mercator bounds (minx, miny, maxx, maxy) of tile z/x/y
+    """
+    size = 2 * WORLD / 2**z
+    minx = -WORLD + x * size
+    maxy = WORLD - y * size
+    return (minx, maxy - size, minx + size, maxy)
+
+def fingerprint(frame, properties):
+    """
+    A token for a layer's content, so the same layer always maps to the same cached tiles
+    """
+    digest = hashlib.sha1(b"".join(shapely.to_wkb(frame.geometry.to_numpy()).tolist()))
+    digest.update(pandas.util.hash_pandas_object(frame[properties], index=False).to_numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+class TileSource():
+    """
+    One layer's features held in EPSG:3857 with an STRtree and cut into tiles on request.
+    Points are thinned to one per few pixels below DETAIL, keeping the highest priority;
+    polygons are clipped, simplified to the tile's pixel size and dropped below a quarter pixel.
+    frame -- GeoDataFrame: geometry with a crs and the property columns
+    properties -- list: columns to put in the tiles
+    priority -- str: column to keep first when thinning points (largest first)
+    """
+    def __init__(self, frame, properties, priority=None):
+        self.token = fingerprint(frame, properties)
+        frame = frame.loc[frame.geometry.notna() & ~frame.geometry.is_empty]
+        if priority is not None:
+            frame = frame.sort_values(by=priority, ascending=False, kind="stable")
+        self.geometries = frame.geometry.to_crs(3857).to_numpy()
+        self.points = bool(self.geometries.shape[0] > 0 and (shapely.get_type_id(self.geometries) == 0).all())
+        self.frame = frame[properties].reset_index(drop=True)
+        self.records = [
+            {k: v.item() if isinstance(v, numpy.generic) else v for k, v in row.items() if not pandas.isna(v)}
+            for row in self.frame.to_dict("records")
+        ]
+        self.tree = shapely.STRtree(self.geometries)
+
+    def quartiles(self, attribute):
+        """
+        Breaks between the quartiles of attribute across the whole layer
+        """
+        return numpy.nanquantile(self.frame[attribute].to_numpy(dtype=float), [.25, .5, .75]).tolist()
+
+    def tile(self, z, x, y):
+        box = bounds(z, x, y)
+        pixel = (box[2] - box[0]) / 256
+        hits = numpy.sort(self.tree.query(shapely.box(*box)))
+        if self.points:
+            if z < DETAIL and hits.shape[0] > 0:
+                cells = numpy.floor((shapely.get_coordinates(self.geometries[hits]) - box[:2]) / (pixel * SPACING)).astype(numpy.int64)
+                first = numpy.unique(cells, axis=0, return_index=True)[1]
+                hits = hits[numpy.sort(first)] # Sorted by priority, so each cell keeps its largest
+            geometries = self.geometries[hits]
+        else:
+            margin = pixel * 4 # So outlines don't show at tile edges
+            geometries = shapely.clip_by_rect(self.geometries[hits], box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin)
+            geometries = shapely.simplify(geometries, pixel, preserve_topology=True)
+            keep = ~shapely.is_empty(geometries) & (shapely.area(geometries) >= pixel * pixel / 4)
+            hits, geometries = hits[keep], geometries[keep]
+        features = [{"geometry": geometry, "properties": self.records[i]} for geometry, i in zip(geometries, hits.tolist())]
+        return mapbox_vector_tile.encode(
+            [{"name": "features", "features": features}],
+            default_options={"quantize_bounds": box, "extents": EXTENT}
+        )
+
+class TileServer():
+    """
+    Serves registered TileSources at <url>/<token>/{z}/{x}/{y}.pbf from a background thread
+    port -- int: port to listen on
+    url -- str: address browsers reach the server at
+    directory -- str: where to cache tiles
+    """
+    def __init__(self, port=PORT, url=URL, directory=DIRECTORY):
+        self.url = url
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.sources = OrderedDict()
+        self.pinned = {}
+        self.places = None # Token of the national Dissemination Area layer, if loaded
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                match = PATH.match(self.path.split("?")[0])
+                body = server.tile(match.group(1), *map(int, match.groups()[1:])) if match else None
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-protobuf")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.send_header("Cache-Control", "max-age=86400")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.httpd = ThreadingHTTPServer(("", port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name="tiles", daemon=True).start()
+
+    def close(self):
+        """
+        Stop serving and release the port
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def register(self, frame, properties, priority=None, pinned=False):
+        """
+        Make a layer's tiles available and return its token; a layer registered
+        before is reused rather than indexed again
+        frame, properties, priority -- as for TileSource
+        pinned -- bool: never drop it to make room for newer layers
+        """
+        token = fingerprint(frame, properties)
+        with self.lock:
+            if token in self.pinned:
+                return token
+            if token in self.sources:
+                self.sources.move_to_end(token)
+                return token
+        source = TileSource(frame, properties, priority)
+        evicted = []
+        with self.lock:
+            if pinned:
+                self.pinned[token] = source
+            else:
+                self.sources[token] = source
+                while len(self.sources) > SOURCES:
+                    evicted.append(self.sources.popitem(last=False)[0])
+        for old in evicted: # Its tiles can't be requested any more
+            shutil.rmtree(os.path.join(self.directory, old), ignore_errors=True)
+        return token
+
+    def prune(self):
+        """
+        Remove cached tiles of layers that aren't registered, e.g. left by an earlier process
+        """
+        with self.lock:
+            known = set(self.pinned) | set(self.sources)
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name not in known:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def source(self, token):
+        with self.lock:
+            return self.pinned.get(token) or self.sources.get(token)
+
+    def tile(self, token, z, x, y):
+        """
+        The encoded tile, from disk when it has been cut before; None for unknown sources
+        """
+        path = os.path.join(self.directory, token, str(z), str(x), str(y) + ".pbf")
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            pass
+        source = self.source(token)
+        if source is None or not (0 <= x < 2**z and 0 <= y < 2**z):
+            return None
+        body = source.tile(z, x, y)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(temporary, path)
+        except OSError:
+            pass
+        return body
+
+    def address(self, token):
+        return self.url + "/" + token + "/{z}/{x}/{y}.pbf"
+
+    def points(self, frame, attribute, name, color):
+        """
+        A tiled layer of circle markers sized by quartile of attribute, like maps.facility_layer()
+        frame -- DataFrame: facilities with latitude, longitude and attribute columns
+        """
+        frame = frame.loc[frame["latitude"].notna() & frame["longitude"].notna()]
+        frame = geopandas.GeoDataFrame(
+            {attribute: frame[attribute].to_numpy(), "radius": radius(frame[attribute]).to_numpy()},
+            geometry=geopandas.points_from_xy(frame["longitude"], frame["latitude"]), crs=4326
+        )
+        token = self.register(frame, [attribute, "radius"], priority="radius")
+        style = "function(properties, zoom) {return {radius: properties.radius, fill: true, fillColor: " + json.dumps(color) + ", fillOpacity: 0.75, color: 'black', weight: .5};}"
+        return VectorGridProtobuf(self.address(token), name, "{\"vectorTileLayerStyles\": {\"features\": " + style + "}, \"rendererFactory\": L.canvas.tile, \"maxNativeZoom\": 14}")
+
+    def choropleth(self, token, attribute, name):
+        """
+        A tiled layer of a registered polygon source shaded by quartile of attribute
+        across all of its features, with the same colours as maps.PlaceGeometry
+        """
+        breaks = self.source(token).quartiles(attribute)
+        style = (
+            "function(properties, zoom) {"
+            "var v = properties[" + json.dumps(attribute) + "]; var b = " + json.dumps(breaks) + ";"
+            "var fill = (v === undefined || v === null) ? 'white' : v <= b[0] ? " + json.dumps(SCALE[0]) + " : v <= b[1] ? " + json.dumps(SCALE[1]) + " : v <= b[2] ? " + json.dumps(SCALE[2]) + " : " + json.dumps(SCALE[3]) + ";"
+            "return {fill: true, fillColor: fill, fillOpacity: 0.4, color: 'black', weight: .2, opacity: .2};}"
+        )
+        return VectorGridProtobuf(self.address(token), name, "{\"vectorTileLayerStyles\": {\"features\": " + style + "}, \"rendererFactory\": L.canvas.tile, \"maxNativeZoom\": 14}")
+
+    def places_layer(self, attribute):
+        """
+        Every Dissemination Area shaded by attribute, or None when they weren't loaded with it
+        """
+        source = self.source(self.places) if self.places is not None else None
+        if source is None or attribute not in source.frame.columns:
+            return None
+        return self.choropleth(self.places, attribute, "All Dissemination Areas")
+
+@st.cache_resource
+def server():
+    """
+    The process's tile server, with the snapshot's Dissemination Areas registered as
+    server.places when places.parquet has scores to shade by; None if tiles aren't
+    available or NPRI_TILE_URL isn't set
+    """
+    if mapbox_vector_tile is None or not URL:
+        return None
+    try:
+        tiles = TileServer()
+    except OSError as e:
+        print("Couldn't start the tile server: ", e)
+        return None
+    path = os.path.join(current() or "", PLACES)
+    if current() is not None and os.path.exists(path):
+        try:
+            frame = pandas.read_parquet(path)
+            frame = geopandas.GeoDataFrame(frame.drop(columns="geom"), geometry=geopandas.GeoSeries.from_wkb(frame["geom"]), crs=3347)
+            if frame.shape[1] > 2: # dauid, geometry and at least one score
+                tiles.places = tiles.register(frame, [c for c in frame.columns if c != "geometry"], pinned=True)
+        except Exception as e:
+            print("Couldn't load Dissemination Areas for tiles: ", e)
+    tiles.prune()
+    return tiles
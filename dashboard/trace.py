@@ -0,0 +1,131 @@
+"""
+Per-rerun timing spans for the dashboard pages.
+
+Set NPRI_TRACE to a file path (or 1 for a file in the temp directory) to append one
+json line per rerun, or add ?debug=1 to a page's URL to show a timing panel for that
+session. When neither is set, spans are a shared no-op.
+"""
+import os
+import json
+import time
+import threading
+import tempfile
+import streamlit as st
+
+LOG = os.environ.get("NPRI_TRACE")
+if LOG == "1":
+    LOG = os.path.join(tempfile.gettempdir(), "npri_trace.jsonl")
+lock = threading.Lock()
+
+class Span():
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """
+        Attach counts to the span, e.g. rows, bytes, cached
+        """
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.attrs["ms"] = round((time.perf_counter() - self.start) * 1000, 2)
+        return False
+
+class NullSpan():
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL = NullSpan()
+
+class Trace():
+    """
+    The spans recorded during one rerun of a page
+    page -- str: page name
+    panel -- bool: show the spans in a debug panel when finished
+    """
+    enabled = True
+
+    def __init__(self, page, panel=False):
+        self.page = page
+        self.panel = panel
+        self.start = time.perf_counter()
+        self.spans = []
+        self.finished = False
+
+    def span(self, name, **attrs):
+        span = Span(name, attrs)
+        self.spans.append(span)
+        return span
+
+    def finish(self, container=None):
+        """
+        Log the rerun and, in debug mode, show it
+        container -- where to put the debug panel (defaults to the page)
+        """
+        self.finished = True
+        record = {
+            "page": self.page,
+            "time": time.time(),
+            "ms": round((time.perf_counter() - self.start) * 1000, 2),
+            "spans": [{"name": span.name, **span.attrs} for span in self.spans],
+        }
+        if LOG:
+            line = json.dumps(record, default=str) + "\n"
+            with lock:
+                with open(LOG, "a") as f:
+                    f.write(line)
+        if self.panel:
+            with (container or st).expander("Debug: rerun timings ({} ms)".format(record["ms"])):
+                st.dataframe(record["spans"], use_container_width=True)
+
+class Nested():
+    """
+    A fragment's view of its enclosing fragment's trace: spans go to the parent,
+    which is logged when the parent finishes
+    """
+    enabled = True
+
+    def __init__(self, parent):
+        self.parent = parent
+
+    def span(self, name, **attrs):
+        return self.parent.span(name, **attrs)
+
+    def finish(self, container=None):
+        pass
+
+class NullTrace():
+    enabled = False
+
+    def span(self, name, **attrs):
+        return NULL
+
+    def finish(self, container=None):
+        pass
+
+def start(page, parent=None):
+    """
+    A Trace for this rerun, or a no-op one when tracing is off
+    page -- str: page name
+    parent -- the enclosing fragment's trace; used while it is still open, i.e. unless
+    this fragment is rerunning on its own
+    """
+    if isinstance(parent, Nested): # A fragment inside a nested fragment feeds the outermost trace
+        parent = parent.parent
+    if isinstance(parent, Trace) and not parent.finished:
+        return Nested(parent)
+    panel = st.query_params.get("debug") == "1"
+    if LOG or panel:
+        return Trace(page, panel)
+    return NullTrace()
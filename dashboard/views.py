@@ -0,0 +1,50 @@
+"""
+Filtered views over cached npri.Facilities / npri.Places objects.
+"""
+import numpy
+from npri import npri
+
+class FilteredView(npri.Maps):
+    """
+    The rows of a cached npri object that pass a filter, without copying the object.
+    Charts read columns through select(); working_data (the filtered rows, including
+    geometry) is only materialized when map features are requested.
+    base -- npri.Facilities or npri.Places, treated as read-only
+    mask -- boolean array over base.data rows
+    """
+    def __init__(self, base, mask):
+        self.base = base
+        self.data = base.data
+        self.index = base.index
+        self.mask = numpy.asarray(mask, dtype=bool)
+        self.features = {}
+        self._working_data = None
+
+    @classmethod
+    def between(cls, base, attribute, bounds):
+        """
+        A view of the rows with attribute in [bounds[0], bounds[1]]
+        """
+        values = base.data[attribute]
+        return cls(base, (values >= bounds[0]) & (values <= bounds[1]))
+
+    @property
+    def working_data(self):
+        if self._working_data is None:
+            self._working_data = self.data.loc[self.mask]
+        return self._working_data
+
+    @working_data.setter
+    def working_data(self, value):
+        # npri.Maps reassigns working_data while styling features
+        self._working_data = value
+
+    def select(self, columns):
+        """
+        The filtered rows of just these columns
+        columns -- list: column names
+        """
+        return self.data.loc[self.mask, columns]
+
+    def __len__(self):
+        return int(self.mask.sum())
@@ -1,29 +1,45 @@
 import streamlit as st
-from npri import npri
-import pandas # installed from npri
+from dashboard import data
+from dashboard.cache import queries
+from dashboard.cube import ReleaseCube
+from dashboard.context import FacilityContext
+from dashboard.maps import facility_layer, PALETTE, MAX_POINTS
+from dashboard import tiles
+from dashboard import charts
+from dashboard import export
+from dashboard import trace as tracing
+from dashboard import health as health_links
+from dashboard.fetch import Fetches
 import folium # installed from npri
 from streamlit_folium import st_folium
-import geopandas
 import altair
-import requests
+import json
 
 @st.cache_data
-def get_substances():
+def get_substances(version):
     try:
-        data, url, report_url = npri.get_npri_data(view=None, endpoint="sql", 
-                                           sql = 'select distinct "Substance" from npri_reports_full_table;') 
-        return data
+        return data.substances()
     except:
         print("Couldn't get data")
-substances = get_substances()
 
 @st.cache_data
-def get_records(substance, years):
+def get_years(version):
     try:
-        data, url, report_url = npri.get_npri_data(view=None, endpoint="sql", 
-                                           sql = 'select "NpriID", "Substance", "ReportYear", "SumInTonnes" from npri_reports_full_table where "ReportYear" >= '+str(years[0])+' and "ReportYear" <= '+str(years[1])+' and lower("Substance") in ({})'.format(','.join('\''+s.lower()+'\'' for s in substance)) 
-                                           )
-        return data
+        return data.years()
+    except:
+        print("Couldn't get data")
+        return data.YEARS
+
+def get_cube(substances, years):
+    """
+    Running totals of every year of releases of these substances, fetched in one query
+    and shared across sessions. Held in the bounded query cache, which counts the cube's
+    arrays against NPRI_CACHE_MB and is cleared when a new snapshot version is swapped in
+    substances -- tuple: substance names
+    years -- tuple: first and last ReportYear in the data
+    """
+    try:
+        return queries.get(("cube", substances, tuple(years)), lambda: ReleaseCube(data.records(list(substances), years), *years))
     except:
         print("Couldn't get data")
 
@@ -31,14 +47,28 @@ cimd = {"median_instability_2021": ["Residential Instability Scores", "the tende
         "median_dependency_2021": ["Economic Dependency Scores", "to reliance on the workforce, or a dependence on sources of income other than employment income"], 
         "median_composition_2021": ["Ethnocultural Composition Scores", "the community make-up of immigrant populations, and at the national-level, for example, takes into consideration indicators such as ... the proportion of the population who self-identified as visible minority..."], 
         "median_vulnerability_2021": ["Situational Vulnerability Scores", "variations in socio-demographic conditions in the areas of housing and education, while taking into account other demographic characteristics"]}    
-def get_context(list_of_ids):
+@st.cache_resource(max_entries=2)
+def get_context(version):
+    """
+    Context for every facility, loaded once per snapshot version and looked up by NpriID
+    """
     try:
-        data, url, report_url = npri.get_npri_data(view=None, endpoint="sql", 
-                                           sql = 'select "NpriID", "NAICSTitleEn", "median_instability_2021", "median_dependency_2021", "median_composition_2021", "median_vulnerability_2021", geom from npri_exporter_table where "NpriID" in ({});'.format(list_of_ids))
-        return data
+        return FacilityContext(data.context(None))
     except:
         print("Couldn't get data")
 
+# Pick up a newly ingested snapshot, and forget results from the one it replaces
+version = data.refresh()
+queries.use(version)
+
+# The context doesn't depend on any selection, so it loads alongside everything else
+fetches = Fetches()
+fetches.add("substances", lambda: get_substances(version))
+fetches.add("years", lambda: get_years(version))
+fetches.add("context", lambda: get_context(version))
+substances = fetches.get("substances")
+health_links.resolver().warm(list(substances["Substance"]))
+
 # PAGE LAYOUT
 top = st.container()
 left, middle = top.columns([.15,.85])
@@ -46,182 +76,224 @@ left.markdown("## Overview")
 middle.markdown("This page provides an overview of facilities reporting releases of regulated substances to the National Pollutant Release Inventory")
 middle.warning("These numbers are facility self-reported estimates compiled by Environment and Climate Change Canada. Please see here for more information about how to interpet NPRI data: https://www.canada.ca/en/environment-climate-change/services/national-pollutant-release-inventory/using-interpreting-data.html")
 
-col1, col2 = st.columns([0.4, 0.6])
-col2a, col2b = col2.columns(2)
+# Each section below is a fragment that reruns on its own when its controls change:
+# substance -> whole page, timeframe -> timeframe(), tonnage filter -> facilities()
+pick, about = st.columns(2)
 
 ## SELECT SUBSTANCES
-idx = 0
-if "substance" in st.query_params.keys():
-    if st.query_params["substance"].lower() in list(substances["Substance"].str.lower()):
-        idx = list(substances["Substance"].str.lower()).index(st.query_params["substance"].lower())
-    else:
-        st.query_params["substance"] = list(substances["Substance"].str.lower())[0]
-else:
-    st.query_params["substance"] = list(substances["Substance"].str.lower())[0]
+options = list(substances["Substance"])
+lowered = [s.lower() for s in options]
+defaults = [options[lowered.index(s.lower())] for s in st.query_params.get_all("substance") if s.lower() in lowered]
+if len(defaults) == 0:
+    defaults = options[:1]
+    st.query_params["substance"] = lowered[0]
 def change_sub_url():
     st.query_params["substance"] = st.session_state.substance
-select_substances  = col2a.selectbox( #multiselect
-    "### **1. Select a pollutant**",
-    substances,
-    index = idx,
+select_substances  = pick.multiselect(
+    "### **1. Select one or more pollutants to compare**",
+    options,
+    default = defaults,
     help = "See more about which substances are required to be reported on and in what amounts here: https://www.canada.ca/en/environment-climate-change/services/national-pollutant-release-inventory/substances-list/threshold.html",
     on_change = change_sub_url,
     key="substance"
 )
+if len(select_substances) == 0:
+    pick.info("Select a pollutant to see facilities reporting it.")
+    st.stop()
+
+fetches.add("cube", lambda years: get_cube(tuple(sorted(select_substances)), years), after=["years"])
 
 ## Get health information
-url = "https://www.canada.ca/en/health-canada/services/chemical-substances/fact-sheets/chemicals-glance/{}.html".format(select_substances.lower().replace(" ", "-"))
-page = requests.get(url)
-if page.status_code == 200:
-    health = "Learn more about "+select_substances+" here: "+ url
-else:
-    health = "Unable to retrieve information about the health effects of  "+select_substances+" at this time. Try searching: https://www.canada.ca/en/health-canada/services/chemical-substances/fact-sheets/chemicals-glance/"
-col2a.info(health, icon="ℹ️")
-
-## SELECT TIMES
-times = [year for year in range(1993,2023)]
-start_time_idx = times[0]
-end_time_idx = times[-1]
-if "start_time" in st.query_params.keys():
-    if int(st.query_params["start_time"]) in times:
-        start_time_idx = int(st.query_params["start_time"])
+for substance in select_substances:
+    health = health_links.message(substance)
+    about.info(health, icon="ℹ️")
+
+@st.fragment
+def timeframe(select_substances, fetches):
+    """
+    Timeframe slider and everything that depends on it
+    """
+    trace = tracing.start("Overview")
+
+    ## SELECT TIMES
+    first, last = fetches.get("years")
+    times = [year for year in range(first, last + 1)]
+    start_time_idx = times[0]
+    end_time_idx = times[-1]
+    if "start_time" in st.query_params.keys():
+        if int(st.query_params["start_time"]) in times:
+            start_time_idx = int(st.query_params["start_time"])
+        else:
+            st.query_params["start_time"] = start_time_idx
     else:
         st.query_params["start_time"] = start_time_idx
-else:
-    st.query_params["start_time"] = start_time_idx
-if "end_time" in st.query_params.keys():
-    if int(st.query_params["end_time"]) in times:
-        end_time_idx = int(st.query_params["end_time"])
+    if "end_time" in st.query_params.keys():
+        if int(st.query_params["end_time"]) in times:
+            end_time_idx = int(st.query_params["end_time"])
+        else:
+            st.query_params["end_time"] = end_time_idx
     else:
         st.query_params["end_time"] = end_time_idx
-else:
-    st.query_params["end_time"] = end_time_idx
-def change_times_url():
-    st.query_params["start_time"] = st.session_state.time[0]
-    st.query_params["end_time"] = st.session_state.time[1]
-select_times = col2a.slider(
-    "### **2. Select a timeframe to focus on**",
-    1993, 2022, (start_time_idx, end_time_idx),
-    step = 1,
-    help = "NPRI began in 1993, but some substances were only added to the list later.",
-    on_change=change_times_url,
-    key="time"
-    )
+    def change_times_url():
+        st.query_params["start_time"] = st.session_state.time[0]
+        st.query_params["end_time"] = st.session_state.time[1]
+    select_times = st.columns(2)[0].slider(
+        "### **2. Select a timeframe to focus on**",
+        first, last, (start_time_idx, end_time_idx),
+        step = 1,
+        help = "NPRI began in 1993, but some substances were only added to the list later.",
+        on_change=change_times_url,
+        key="time"
+        )
 
-## Get data
-records = get_records([select_substances], select_times)
-
-## Prep data
-ids = list(records["NpriID"].unique())
-list_of_ids = ""
-for id in ids:
-    list_of_ids += str(id) + ","
-list_of_ids = list_of_ids[:-1]
-context = get_context(list_of_ids)
-try:
-    context['geometry'] = geopandas.GeoSeries.from_wkb(context['geom'])
-    context.drop("geom", axis=1, inplace=True)
-    context.set_index("NpriID", inplace=True)
-except: # No facilities found
-    st.error("Something went wrong - it may be that there are no facilities that reported "+select_substances+" for this timeframe. In some cases, there may be too many facilities for us to display. Try selecting a different range of years.")
-    st.stop()
+    ## Get data
+    with trace.span("fetch", substance=select_substances) as span:
+        cube = fetches.get("cube")
+        context_store = fetches.get("context")
+        span.set(facilities=cube.ids.shape[0], cache=queries.stats(), fetches=dict(fetches.timings))
 
-## Aggregate by NpriID
-aggregate = records.groupby(by=["NpriID", "Substance"])[["SumInTonnes"]].sum().reset_index()
-aggregate.set_index("NpriID", inplace=True)
-
-## Facility filter
-select_facs = col2a.slider(
-    "### **3. Filter the facilities releasing "+ select_substances +" in this range (tonnes):**",
-    aggregate["SumInTonnes"].min()-.01, aggregate["SumInTonnes"].max()+.01, (aggregate["SumInTonnes"].min(), aggregate["SumInTonnes"].max()))
-aggregate = aggregate.loc[(aggregate["SumInTonnes"]>=select_facs[0]) & (aggregate["SumInTonnes"]<=select_facs[1])]
-
-## Calculate industry metrics
-ind = aggregate.join(context[["NAICSTitleEn"]])
-ind = ind.groupby(by=["NAICSTitleEn", "Substance"])[["SumInTonnes"]].sum().reset_index()
-ind.set_index("NAICSTitleEn", inplace=True)
-
-## Facilities
-col2b.markdown("### {} | {} | {}".format(
-    select_substances, 
-    str(select_times[0]) + "-" + str(select_times[1]),
-    str(round(select_facs[0],2)) + "-" + str(round(select_facs[1],2)) + " tonnes",
-    )
-) 
-col2b.markdown("#### Top 10 Facilities ({} total)".format(str(aggregate.shape[0])))
-toptentotal = aggregate.sort_values(by="SumInTonnes", ascending=False).head(10)
-toptentotal.reset_index(inplace=True)
-toptentotal["NpriID"] = toptentotal["NpriID"].astype(str)
-col2b.altair_chart(
-    altair.Chart(toptentotal).mark_bar().encode(
-        x=altair.X("SumInTonnes"),
-        y=altair.Y("NpriID" ).sort('-x')
-    )
-)
-## Industries 
-col2b.markdown("#### Top 10 Industries ({} total)".format(str(ind.shape[0])))
-toptenind = ind.sort_values(by="SumInTonnes", ascending=False).head(10)
-
-toptenind.reset_index(inplace=True)
-col2b.altair_chart(
-    altair.Chart(toptenind).mark_bar().encode(
-        x=altair.X("SumInTonnes"),
-        y=altair.Y("NAICSTitleEn" ).sort('-x')
-    )
-)
+    ## Aggregate by NpriID
+    with trace.span("aggregate", years=select_times) as span:
+        aggregate = cube.totals(select_times)
+        context = context_store.lookup(aggregate.index.unique()) # One row per facility, shared by every substance
+        span.set(rows=aggregate.shape[0])
 
-# Prep map
-m = folium.Map(tiles="cartodb positron", zoom_start = 4, location=(60,-100))
-fg = folium.FeatureGroup(name="Facilities")
-
-markers = []
-
-## Markers
-aggregate['quantile'] = pandas.qcut(aggregate["SumInTonnes"], 4, labels=False, duplicates="drop") #duplicates drop to handle single facility
-aggregate.loc[aggregate['quantile'].isna(),'quantile'] = 3 # Deafult marker size
-to_mark = aggregate.join(context, how="left")
-to_mark = geopandas.GeoDataFrame(to_mark, crs=3347)   
-to_mark.to_crs(4326, inplace=True)
-to_mark.set_geometry("geometry", inplace=True)
-markers.extend([folium.CircleMarker(location=[mark.geometry.y, mark.geometry.x], 
-    popup=folium.Popup(
-        '<b>NPRI ID: </b>'+str(index)+
-        '<br><b>Industry:</b> {}'.format(mark["NAICSTitleEn"])+
-        '<br><b>{}:</b> '.format(select_substances)+str(mark["SumInTonnes"])+
-        "<br><b>Median Residential Instability Score: </b>'"+str(mark["median_instability_2021"]) +
-        "<br><b>Median Economic Dependency Score: </b>'"+str(mark["median_dependency_2021"]) +
-        "<br><b>Median Ethnocultural Composition Score: </b>'"+str(mark["median_composition_2021"]) +
-        "<br><b>Median Situational Vulnerability Score: </b>'"+str(mark["median_vulnerability_2021"])
-    ),
-    radius=(mark["quantile"] * 5) + 3, fill_color="#FFA500", weight=.5, fill_opacity=0.75
-    ) for index, mark in to_mark.iterrows() if mark.geometry is not None
-])
-## Bar chart
-col2b.markdown("#### Totals over time")
-col2b.bar_chart(records.loc[(records["Substance"]==select_substances) & records["NpriID"].isin(list(aggregate.index))][["ReportYear", "SumInTonnes"]].sort_values(by="SumInTonnes"), x = "ReportYear", y="SumInTonnes", color="#FFA500")
-
-# Make larger markers appear in the back so as to not obscure small markers
-markers.sort(key=lambda x: x.options["radius"], reverse=True)
-for marker in markers:
-    fg.add_child(marker)
-
-with col1:
-    st_folium(
-        m,
-        feature_group_to_add=fg,
-        returned_objects=[],
-        use_container_width=True
-    )
-    #st.warning('There are '+str(nodata)+' facilities without records on '+selector+' and an additional '+str(unmappable)+' that cannot be mapped', icon="⚠️")
-
-# CIMD
-col2a.markdown("#### 2021 Canadian Index of Multiple Deprivation")
-for metric in cimd.keys():
-    #col2a.metric("Median of "+cimd[metric][0], 
-    #        round(context.loc[context.index.isin(list(aggregate.index))][[metric]].median(),2),
-    #        help = cimd[metric][0] + " refers to " + cimd[metric][1] + " as measured across Census Dissemination Areas within 5km of #these facilities."
-    #        )
-    col2a.metric("Max of "+cimd[metric][0], 
-            round(context.loc[context.index.isin(list(aggregate.index))][[metric]].max(),2),
-            help = cimd[metric][0] + " refers to " + cimd[metric][1] + " as measured across Census Dissemination Areas within 5km of these facilities. See here: https://www150.statcan.gc.ca/n1/pub/45-20-0001/452000012023002-eng.htm"
+    ## Prep data
+    if aggregate.shape[0] == 0: # No facilities found
+        st.error("Something went wrong - it may be that there are no facilities that reported "+", ".join(select_substances)+" for this timeframe. Try selecting a different range of years.")
+        st.stop()
+
+    facilities(select_substances, select_times, cube, aggregate, context, trace)
+    trace.finish()
+
+@st.fragment
+def facilities(select_substances, select_times, cube, aggregate, context, parent):
+    """
+    Tonnage filter, charts, map and CIMD metrics for the facilities in the timeframe
+    """
+    trace = tracing.start("Overview", parent=parent)
+
+    ## Facility filter
+    select_facs = st.columns(2)[0].slider(
+        "### **3. Filter the facilities releasing "+ ", ".join(select_substances) +" in this range (tonnes):**",
+        aggregate["SumInTonnes"].min()-.01, aggregate["SumInTonnes"].max()+.01, (aggregate["SumInTonnes"].min(), aggregate["SumInTonnes"].max()))
+    with trace.span("filter") as span:
+        aggregate = aggregate.loc[(aggregate["SumInTonnes"]>=select_facs[0]) & (aggregate["SumInTonnes"]<=select_facs[1])]
+
+        ## Calculate industry metrics
+        ind = cube.industries(aggregate, context["NAICSTitleEn"])
+        span.set(rows=aggregate.shape[0], industries=ind.shape[0])
+
+    col1, col2 = st.columns([0.4, 0.6])
+    col2a, col2b = col2.columns(2)
+    # Same colour per substance in every chart and on the map
+    colors = altair.Color("Substance", scale=altair.Scale(domain=cube.substances, range=PALETTE[:len(cube.substances)]), legend=altair.Legend(orient="bottom"))
+
+    ## Facilities
+    with trace.span("chart", chart="top 10"):
+        col2b.markdown("### {} | {} | {}".format(
+            ", ".join(select_substances), 
+            str(select_times[0]) + "-" + str(select_times[1]),
+            str(round(select_facs[0],2)) + "-" + str(round(select_facs[1],2)) + " tonnes",
+            )
+        ) 
+        # Top 10 by total across the selected substances, stacked by substance, and the rest as "Other"
+        col2b.markdown("#### Top 10 Facilities ({} total)".format(str(aggregate.index.nunique())))
+        toptentotal, order = charts.top(aggregate.reset_index(), "NpriID")
+        col2b.altair_chart(
+            altair.Chart(toptentotal).mark_bar().encode(
+                x=altair.X("sum(SumInTonnes)", title="SumInTonnes"),
+                y=altair.Y("NpriID" ).sort(order),
+                color=colors
+            )
+        )
+        ## Industries 
+        col2b.markdown("#### Top 10 Industries ({} total)".format(str(ind.index.nunique())))
+        toptenind, order = charts.top(ind.reset_index(), "NAICSTitleEn")
+        col2b.altair_chart(
+            altair.Chart(toptenind).mark_bar().encode(
+                x=altair.X("sum(SumInTonnes)", title="SumInTonnes"),
+                y=altair.Y("NAICSTitleEn" ).sort(order),
+                color=colors
             )
+        )
+
+    # Prep map
+    m = folium.Map(tiles="cartodb positron", zoom_start = 4, location=(60,-100))
+    fg = folium.FeatureGroup(name="Facilities")
+
+    ## Markers, one layer per substance
+    with trace.span("geometry") as span:
+        to_mark = aggregate.join(context, how="left")
+        tile_server = tiles.server()
+        features, size = 0, 0
+        for i, substance in enumerate(cube.substances):
+            these = to_mark.loc[to_mark["Substance"] == substance]
+            if these.shape[0] == 0:
+                continue
+            if tile_server is not None and these.shape[0] > MAX_POINTS: # Every facility, as vector tiles
+                m.add_child(tile_server.points(these, "SumInTonnes", substance, PALETTE[i % len(PALETTE)]))
+                continue
+            layer = facility_layer(these, "SumInTonnes", {
+                "NpriID": "NPRI ID",
+                "NAICSTitleEn": "Industry",
+                "SumInTonnes": substance,
+                "median_instability_2021": "Median Residential Instability Score",
+                "median_dependency_2021": "Median Economic Dependency Score",
+                "median_composition_2021": "Median Ethnocultural Composition Score",
+                "median_vulnerability_2021": "Median Situational Vulnerability Score",
+            }, name=substance, color=PALETTE[i % len(PALETTE)])
+            fg.add_child(layer)
+            if trace.enabled:
+                features += len(layer.data["features"])
+                size += len(json.dumps(layer.data))
+        if trace.enabled:
+            span.set(features=features, bytes=size)
+    ## Bar chart
+    with trace.span("chart", chart="totals over time"):
+        col2b.markdown("#### Totals over time")
+        col2b.altair_chart(
+            altair.Chart(cube.yearly(select_times, aggregate)).mark_bar().encode(
+                x=altair.X("ReportYear:O"),
+                y=altair.Y("sum(SumInTonnes)", title="SumInTonnes"),
+                color=colors
+            )
+        )
+
+    with col1, trace.span("map"):
+        st_folium(
+            m,
+            feature_group_to_add=fg,
+            returned_objects=[],
+            use_container_width=True
+        )
+        #st.warning('There are '+str(nodata)+' facilities without records on '+selector+' and an additional '+str(unmappable)+' that cannot be mapped', icon="⚠️")
+
+    # CIMD
+    col2a.markdown("#### 2021 Canadian Index of Multiple Deprivation")
+    for metric in cimd.keys():
+        #col2a.metric("Median of "+cimd[metric][0], 
+        #        round(context.loc[context.index.isin(list(aggregate.index))][[metric]].median(),2),
+        #        help = cimd[metric][0] + " refers to " + cimd[metric][1] + " as measured across Census Dissemination Areas within 5km of #these facilities."
+        #        )
+        col2a.metric("Max of "+cimd[metric][0], 
+                round(context.loc[context.index.isin(list(aggregate.index))][[metric]].max(),2),
+                help = cimd[metric][0] + " refers to " + cimd[metric][1] + " as measured across Census Dissemination Areas within 5km of these facilities. See here: https://www150.statcan.gc.ca/n1/pub/45-20-0001/452000012023002-eng.htm"
+                )
+
+    # Download
+    col2a.markdown("#### Download these facilities")
+    extension, mime = export.FORMATS[col2a.radio("Format", list(export.FORMATS), horizontal=True, key="export_format")]
+    col2a.download_button(
+        "Download",
+        # Written a chunk of facilities at a time when clicked
+        lambda: export.write(export.chunks(aggregate, join=context, constants={"FirstYear": select_times[0], "LastYear": select_times[1]}), extension),
+        file_name=export.name(["npri"] + select_substances + [select_times[0], select_times[1]], extension),
+        mime=mime,
+        on_click="ignore",
+        help="Each facility's total of each selected substance in this timeframe and tonnage range, with its industry, location and CIMD scores"
+    )
+
+    trace.finish(col2a)
+
+timeframe(select_substances, fetches)
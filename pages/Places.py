@@ -1,10 +1,21 @@
 import streamlit as st
-from npri import npri
+from dashboard import data
+from dashboard.cache import queries
+from dashboard import health as health_links
+from dashboard.views import FilteredView
+from dashboard.maps import PlaceGeometry, TOLERANCE
+from dashboard import charts
+from dashboard import export
+from dashboard import tiles
+from dashboard.index import FSAIndex, FSABundles
+from dashboard.allocate import Locations, Allocation, RADII, RADIUS
+from dashboard import trace as tracing
+from dashboard.fetch import Fetches
 from streamlit_folium import st_folium
 import folium # installed from npri
 import altair
-from copy import deepcopy
-import requests
+import pandas
+import json
 
 substances = ["Carbon monoxide",
             "Sulphur dioxide",
@@ -14,72 +25,120 @@ substances = ["Carbon monoxide",
             "Nitrogen oxides (expressed as nitrogen dioxide)",
             "Volatile Organic Compounds (Total)"
             ]
+health_links.resolver().warm(substances)
 times = ["Most Recent", "Past 5 Years", "Past 15 Years", "All Years"]
+spans = {"Most Recent": 1, "Past 5 Years": 5, "Past 15 Years": 15, "All Years": None} # ReportYears in each timeframe
 cimd = {"Residential instability Scores": ["Residential Instability Scores", "the tendency of neighbourhood inhabitants to fluctuate over time, taking into consideration both housing and familial characteristics"],
         "Economic dependency Scores": ["Economic Dependency Scores", "to reliance on the workforce, or a dependence on sources of income other than employment income"], 
         "Ethno-cultural composition Scores": ["Ethnocultural Composition Scores", "the community make-up of immigrant populations, and at the national-level, for example, takes into consideration indicators such as ... the proportion of the population who self-identified as visible minority..."], 
         "Situational vulnerability Scores": ["Situational Vulnerability Scores", "variations in socio-demographic conditions in the areas of housing and education, while taking into account other demographic characteristics"]}    
 
 @st.cache_data
-def get_this_fsa(fsa):
+def get_this_fsa(fsa, version):
     """
-    Load geometry of FSA for mapping purposes (need to add FSA shapes to Google db)
+    Load geometry of FSA for mapping purposes (need to add FSA shapes to Google db).
+    Kept in st.cache_data rather than the query cache so a failed lookup (None) is
+    remembered too, instead of being retried on every rerun
     """
     try:
         print("getting data...")
-        data, url, report_url = npri.get_npri_data(view=None, endpoint="sql", 
-                                           sql = 'select * from from lfsa.... where X = \''+fsa+'\';')
-        return data
+        return data.fsa(fsa)
     except:
         print("Couldn't get data")
 
+# Pick up a newly ingested snapshot, and forget results from the one it replaces
+version = data.refresh()
+queries.use(version)
+
 @st.cache_data
-def get_fsas():
+def get_fsas(version):
     try:
         print("getting data...")
-        data, url, report_url = npri.get_npri_data(view=None, endpoint="sql", 
-                                           sql = 'select distinct "ForwardSortationArea" from npri_exporter_table;')
-        return data
+        return data.fsas()
     except:
         print("Couldn't get data")
-fsas = get_fsas()
+fsas = get_fsas(version)
 
-@st.cache_data
-def get_places(fsa):
+@st.cache_resource(max_entries=2)
+def get_bundles(version):
+    """
+    Places and facilities for each FSA, shared across sessions (read-only: pages filter
+    them through FilteredView) and loaded in the background, most-visited FSAs first;
+    one set per snapshot version
+    """
+    bundles = FSABundles(FSAIndex.load())
+    bundles.warm(list(fsas["ForwardSortationArea"].unique()))
+    return bundles
+
+def get_fsa(fsa):
     """
     fsa -- str: selected FSA
     """
-    fsa = [fsa]
     try:
         print("getting data...")
-        data = npri.Places(place=fsa)
-        return data
+        return get_bundles(version).get(fsa)
     except:
         print("Couldn't get data")
 
+@st.cache_resource
+def get_place_geometry(fsa, version, _places, tolerance=TOLERANCE):
+    """
+    Simplified DA geometry for the FSA, keyed by FSA, version and tolerance (_places is not hashed)
+    """
+    return PlaceGeometry(_places.data, tolerance)
+
 @st.cache_data
-def get_facilities(dauids):
+def get_years(version):
+    try:
+        return data.years()
+    except:
+        print("Couldn't get data")
+        return data.YEARS
+
+@st.cache_resource(max_entries=2)
+def get_locations(version):
     """
-    dauids -- list: DAUIDs that intersect the selected FSA 
+    Every facility's location, loaded once per snapshot version to find those around an FSA
     """
-    #st.write(dauids)
     try:
         print("getting data...")
-        data = npri.Facilities(within=dauids)
-        return data
+        return Locations(data.context(None, ["NpriID", "geom"]))
     except:
         print("Couldn't get data")
 
-@st.cache_data 
-def get_context(list_of_ids):
+@st.cache_resource(max_entries=64)
+def get_allocation(fsa, radius, version, _places):
+    """
+    Facility x DA weights for the FSA's DAs at this buffer radius, keyed by FSA, radius
+    and version (_places is not hashed); None if facility locations couldn't be loaded
+    """
+    locations = get_locations(version)
+    if locations is None:
+        return None
+    return Allocation(locations, _places.data, radius)
+
+def get_releases(substance, time, allocation):
+    """
+    Total releases of substance over the timeframe by just the facilities allocation
+    covers, indexed by NpriID; None without an allocation
+    """
+    if allocation is None:
+        return None
     try:
-        print("getting data...")
-        data, url, report_url = npri.get_npri_data(view=None, endpoint="sql", 
-                                           sql = 'select "NpriID", "median_instability_2021", geom from npri_exporter_table where "NpriID" in ({});'.format(list_of_ids))
-        return data
+        first, last = get_years(version)
+        years = (first if spans[time] is None else last - spans[time] + 1, last)
+        ids = sorted(allocation.ids.tolist())
+        if len(ids) == 0:
+            return pandas.Series(dtype="float64")
+        return queries.get(
+            ("releases", substance.lower(), years, tuple(ids)),
+            lambda: data.records([substance], years, ids).groupby("NpriID", observed=True)["SumInTonnes"].sum()
+        )
     except:
         print("Couldn't get data")
 
+trace = tracing.start("Places")
+
 # PAGE LAYOUT
 top = st.container()
 left, middle = top.columns([.15,.85])
@@ -87,7 +146,10 @@ left.markdown("## Places")
 middle.markdown("This page provides more information about facilities in a given place reporting releases of regulated substances to the National Pollutant Release Inventory")
 middle.warning("These numbers are facility self-reported estimates compiled by Environment and Climate Change Canada. Please see here for more information about how to interpet NPRI data: https://www.canada.ca/en/environment-climate-change/services/national-pollutant-release-inventory/using-interpreting-data.html")
 
-col1, col2 = st.columns([0.4, 0.6])
+# Each section below is a fragment that reruns on its own when its controls change:
+# FSA/substance/timeframe -> whole page, tonnage filter -> facilities_view(),
+# CIMD indicator and range -> places_view()
+pick_fsa, pick_substance, pick_time = st.columns(3)
 
 # SELECTIONS
 ## Select FSA
@@ -101,7 +163,7 @@ else:
     st.query_params["fsa"] = list(fsas["ForwardSortationArea"].unique())[0]
 def change_fsa_url():
     st.query_params["fsa"] = st.session_state.fsa
-select_fsa  = col2.selectbox(
+select_fsa  = pick_fsa.selectbox(
     "### **1. Select an FSA**",
     list(fsas["ForwardSortationArea"].unique()),
     index = idx,
@@ -110,8 +172,6 @@ select_fsa  = col2.selectbox(
     key="fsa"
 )
 
-col2a, col2b = col2.columns(2)
-
 ## Select substance
 idx = 0
 if "substance" in st.query_params.keys():
@@ -123,7 +183,7 @@ else:
     st.query_params["substance"] = substances[0]
 def change_sub_url():
     st.query_params["substance"] = st.session_state.substance
-select_substance  = col2a.selectbox( #multiselect
+select_substance  = pick_substance.selectbox( #multiselect
     "### **2. Select a Criteria Air Contaminant**",
     substances,
     index=idx,
@@ -132,13 +192,8 @@ select_substance  = col2a.selectbox( #multiselect
     key="substance"
 )
 ## Get health information
-url = "https://www.canada.ca/en/health-canada/services/chemical-substances/fact-sheets/chemicals-glance/{}.html".format(select_substance.lower().replace(" ", "-"))
-page = requests.get(url)
-if page.status_code == 200:
-    health = "Learn more about "+select_substance+" here: "+ url
-else:
-    health = "Unable to retrieve information about the health effects of "+select_substance+" at this time. Try searching: https://www.canada.ca/en/health-canada/services/chemical-substances/fact-sheets/chemicals-glance/"
-col2a.info(health, icon="ℹ️")
+health = health_links.message(select_substance)
+pick_substance.info(health, icon="ℹ️")
 
 ## Select time
 idx = 0
@@ -151,7 +206,7 @@ else:
     st.query_params["timeframe"] = times[0]
 def change_times_url():
     st.query_params["timeframe"] = st.session_state.time
-select_time  = col2a.selectbox(
+select_time  = pick_time.selectbox(
     "### **3. Select a timeframe**",
     times,
     index=idx, 
@@ -162,101 +217,189 @@ select_time  = col2a.selectbox(
 
 
 # GET DATA
-places = get_places(select_fsa)
-this_fsa = get_this_fsa(select_fsa)
+with trace.span("fetch", fsa=select_fsa) as span:
+    span.set(cached=get_bundles(version).loaded(select_fsa))
+    fetches = Fetches()
+    fetches.add("bundle", lambda: get_fsa(select_fsa))
+    fetches.add("this_fsa", lambda: get_this_fsa(select_fsa, version))
+    fetches.add("geometry", lambda bundle: get_place_geometry(select_fsa, version, bundle[0]), after=["bundle"]) # Ready by the time places_view() maps it
+    # For the radius last picked; places_view() computes others itself
+    select_radius = st.session_state.get("radius", RADIUS)
+    fetches.add("allocation " + str(select_radius), lambda bundle: get_allocation(select_fsa, select_radius, version, bundle[0]), after=["bundle"])
+    fetches.add("releases " + str(select_radius), lambda allocation: get_releases(select_substance, select_time, allocation), after=["allocation " + str(select_radius)])
+    places, facilities = fetches.get("bundle")
+    this_fsa = fetches.get("this_fsa")
+    span.set(places=places.data.shape[0], facilities=facilities.data.shape[0], cache=queries.stats(), fetches=dict(fetches.timings))
 #st.write(places.data)
-dauids = list(places.data.index.unique())
-facilities = get_facilities(dauids)
 #st.write(facilities.data)
 
 # Process data
 select_measure = select_substance + " - " + select_time
-min = facilities.data[select_measure].min()
-max = facilities.data[select_measure].max()
-filter_fac = col2a.slider(
-    "### **4. Filter the facilities releasing "+ select_substance +" in this range (tonnes):**",
-    min-.01, max+.01, (min, max)
-    )
-filtered = deepcopy(facilities)
-filtered.working_data = filtered.working_data.loc[(filtered.working_data[select_measure]>=filter_fac[0]) & (filtered.working_data[select_measure]<=filter_fac[1])]
-#st.write(filtered)
-
-# Chart data
-col2b.markdown("### {} | {} | {} ".format(
-    select_fsa, 
-    select_measure,
-    str(round(filter_fac[0],2)) + "-" + str(round(filter_fac[1],2)) + " tonnes",
-    )
-) 
-
-to_chart = filtered.working_data.reset_index()[["NpriID", select_measure]]
-to_chart["NpriID"] = to_chart["NpriID"].astype(str)
-col2b.markdown("#### Top 10 Facilities ({} total)".format(str(to_chart.shape[0])))
-col2b.altair_chart(
-    altair.Chart(to_chart.sort_values(by=select_measure, ascending=False).head(10)).mark_bar().encode(
-        x=altair.X(select_measure),
-        y=altair.Y("NpriID" ).sort('-x')
+
+@st.fragment
+def facilities_view(select_fsa, select_substance, select_time, select_measure, facilities, places, fetches, parent):
+    """
+    Tonnage filter and facility charts; builds the markers places_view() maps
+    fetches -- Fetches: the page's, with the FSA's geometry and allocation
+    """
+    trace = tracing.start("Places", parent=parent)
+    col2a, col2b = st.columns(2)
+
+    min = float(facilities.data[select_measure].min()) # float32 columns; sliders need python floats
+    max = float(facilities.data[select_measure].max())
+    filter_fac = col2a.slider(
+        "### **4. Filter the facilities releasing "+ select_substance +" in this range (tonnes):**",
+        min-.01, max+.01, (min, max)
+        )
+    with trace.span("filter", measure=select_measure) as span:
+        filtered = FilteredView.between(facilities, select_measure, filter_fac)
+        span.set(rows=len(filtered))
+
+    # Chart data
+    with trace.span("chart", chart="top 10"):
+        col2b.markdown("### {} | {} | {} ".format(
+            select_fsa, 
+            select_measure,
+            str(round(filter_fac[0],2)) + "-" + str(round(filter_fac[1],2)) + " tonnes",
+            )
+        ) 
+
+        to_chart = filtered.select([select_measure]).reset_index()
+        col2b.markdown("#### Top 10 Facilities ({} total)".format(str(to_chart.shape[0])))
+        toptentotal, order = charts.top(to_chart, "NpriID", select_measure)
+        col2b.altair_chart(
+            altair.Chart(toptentotal).mark_bar().encode(
+                x=altair.X(select_measure),
+                y=altair.Y("NpriID" ).sort(order)
+            )
+        )
+        # Industries
+        toptenind = filtered.select(["NAICSTitleEn", select_measure]).dropna(subset=[select_measure]).groupby(by="NAICSTitleEn", observed=True)[[select_measure]].sum()
+        col2b.markdown("#### Top 10 Industries ({} total)".format(str(toptenind.shape[0])))
+        toptenind, order = charts.top(toptenind.reset_index(), "NAICSTitleEn", select_measure)
+        col2b.altair_chart(
+            altair.Chart(toptenind).mark_bar().encode(
+                x=altair.X(select_measure),
+                y=altair.Y("NAICSTitleEn" ).sort(order)
+            )
+        )
+
+    with trace.span("geometry", layer="facilities"):
+        markers = filtered.get_features(select_measure) if len(filtered) > 0 else [] # npri can't style an empty selection
+
+    # Download, written a chunk at a time when clicked
+    extension, mime = export.FORMATS[col2a.radio("Download format", list(export.FORMATS), horizontal=True, key="export_format")]
+    col2a.download_button(
+        "Download these facilities",
+        lambda: export.write(export.chunks(facilities.data, filtered.mask, ["NAICSTitleEn", select_measure], constants={"ForwardSortationArea": select_fsa}, coordinates=True), extension),
+        file_name=export.name(["npri", select_fsa, select_measure], extension),
+        mime=mime,
+        on_click="ignore",
+        help="The facilities in this FSA and tonnage range, with their industry and location"
     )
-)
-# Industries
-toptenind = filtered.working_data.reset_index().loc[~filtered.working_data.reset_index()[select_measure].isna()].groupby(by="NAICSTitleEn")[[select_measure]].sum()
-col2b.markdown("#### Top 10 Industries ({} total)".format(str(toptenind.shape[0])))
-toptenind = toptenind.reset_index().sort_values(by=select_measure, ascending=False).head(10)
-col2b.altair_chart(
-    altair.Chart(toptenind).mark_bar().encode(
-        x=altair.X(select_measure),
-        y=altair.Y("NAICSTitleEn" ).sort('-x')
+
+    places_view(select_fsa, select_substance, select_time, places, markers, (extension, mime), fetches, trace)
+    trace.finish(col2a)
+
+@st.fragment
+def places_view(select_fsa, select_substance, select_time, places, markers, download, fetches, parent):
+    """
+    CIMD indicator and range, buffer radius, DA scatter plot and metrics, and the map
+    download -- tuple: file extension and mime type for downloads, from export.FORMATS
+    """
+    trace = tracing.start("Places", parent=parent)
+    col1, col2 = st.columns([0.4, 0.6])
+    col2a, col2b = col2.columns(2)
+
+    # PLACES
+    select_attribute_place = col2a.selectbox(
+        "### **5. Select a Census indicator of 'deprivation' to display**",
+        cimd.keys(),
+        help =  "".join(s[0] + " " + s[1] + ". " for s in cimd.values()) + "See here: https://www150.statcan.gc.ca/n1/pub/45-20-0001/452000012023002-eng.htm"
     )
-)
+    #col2a.info(cimd[select_attribute_place][0] + " refers to " + cimd[select_attribute_place][1] + ".",icon="ℹ️")
+    min = float(places.data[select_attribute_place].min())
+    max = float(places.data[select_attribute_place].max())
+    filter_place = col2a.slider(
+        "### **6. Focus on Census Dissemination Areas with " + select_attribute_place + " in this range:**",
+        min, max, (min, max)
+        )
+    with trace.span("filter", measure=select_attribute_place) as span:
+        filtered_places = FilteredView.between(places, select_attribute_place, filter_place)
+        span.set(rows=len(filtered_places))
 
-# PLACES
-select_attribute_place = col2a.selectbox(
-    "### **5. Select a Census indicator of 'deprivation' to display**",
-    cimd.keys(),
-    help =  "".join(s[0] + " " + s[1] + ". " for s in cimd.values()) + "See here: https://www150.statcan.gc.ca/n1/pub/45-20-0001/452000012023002-eng.htm"
-)
-#col2a.info(cimd[select_attribute_place][0] + " refers to " + cimd[select_attribute_place][1] + ".",icon="ℹ️")
-min = places.data[select_attribute_place].min()
-max = places.data[select_attribute_place].max()
-filter_place = col2a.slider(
-    "### **6. Focus on Census Dissemination Areas with " + select_attribute_place + " in this range:**",
-    min, max, (min, max)
+    # Allocation
+    x = select_substance + " - Allocated"
+    y = select_attribute_place
+    col2b.markdown("#### Characteristics of Dissemination Areas")
+    radius = col2b.select_slider("Allocate releases within this distance of each facility (km)", RADII, value=RADIUS, key="radius")
+    with trace.span("allocate", radius=radius) as span:
+        try:
+            if "allocation " + str(radius) in fetches:
+                allocation, releases = fetches.get("allocation " + str(radius)), fetches.get("releases " + str(radius))
+            else:
+                allocation = get_allocation(select_fsa, radius, version, places)
+                releases = get_releases(select_substance, select_time, allocation)
+        except Exception as e:
+            print("Couldn't allocate releases: ", e)
+            allocation, releases = None, None
+        if allocation is not None and releases is not None:
+            allocated = allocation.allocate(releases).rename(x)
+            span.set(facilities=allocation.ids.shape[0], weights=allocation.weights.shape[0])
+        else: # npri's own allocation
+            allocated = places.data[x]
+            radius = RADIUS
+
+    # Scatter plot
+    with trace.span("chart", chart="scatter"):
+        col2b.info("Here, releases of "+select_substance+" are 'allocated' across the Census Dissemination Areas that are within "+str(radius)+" km of polluting facilities, based on how much each Dissemination Area intersects with that buffer",icon="ℹ️")
+        to_chart = pandas.DataFrame({x: allocated.to_numpy()[filtered_places.mask], y: filtered_places.select(y).to_numpy()})
+        col2b.scatter_chart(charts.scatter(to_chart, x, y), x=x, y=y, size="count")
+
+    # CIMD
+    #x, y = col2a.columns([.5,.5])
+    col2a.metric("Median of "+cimd[select_attribute_place][0]+ " in all Dissemination Areas intersecting with this FSA", round(filtered_places.select(select_attribute_place).median(),2))
+    col2a.metric("Max of "+cimd[select_attribute_place][0]+ " in all Dissemination Areas intersecting with this FSA", round(filtered_places.select(select_attribute_place).max(),2)) 
+
+    # Download
+    extension, mime = download
+    col2a.download_button(
+        "Download these Dissemination Areas",
+        lambda: export.write(export.chunks(places.data, filtered_places.mask, list(cimd.keys()), join=allocated.to_frame(x), constants={"ForwardSortationArea": select_fsa, "BufferKm": radius}), extension),
+        file_name=export.name(["npri", select_fsa, select_substance, "dissemination areas"], extension),
+        mime=mime,
+        on_click="ignore",
+        help="The Dissemination Areas in this FSA and " + select_attribute_place + " range, with their CIMD scores and releases of " + select_substance + " allocated within " + str(radius) + " km"
     )
-filtered_places = deepcopy(places)
-filtered_places.working_data = filtered_places.working_data.loc[(filtered_places.working_data[select_attribute_place]>=filter_place[0]) & (filtered_places.working_data[select_attribute_place]<=filter_place[1])]
-#st.write(filtered)
-
-# Scatter plot
-x = select_substance + " - Allocated"
-y = select_attribute_place
-col2b.markdown("#### Characteristics of Dissemination Areas")
-col2b.info("Here, releases of "+select_substance+" are 'allocated' across the Census Dissemination Areas that are within 5 km of polluting facilities, based on how much each Dissemination Area intersects with that buffer",icon="ℹ️")
-col2b.scatter_chart(filtered_places.working_data.reset_index(), x=x, y=y)
-
-# CIMD
-#x, y = col2a.columns([.5,.5])
-col2a.metric("Median of "+cimd[select_attribute_place][0]+ " in all Dissemination Areas intersecting with this FSA", round(filtered_places.working_data[select_attribute_place].median(),2))
-col2a.metric("Max of "+cimd[select_attribute_place][0]+ " in all Dissemination Areas intersecting with this FSA", round(filtered_places.working_data[select_attribute_place].max(),2)) 
-
-
-# Map
-filtered.get_features(select_measure)
-filtered_places.get_features(select_attribute_place)
-lat = (filtered_places.features[select_attribute_place][0].get_bounds()[1][0] + filtered_places.features[select_attribute_place][0].get_bounds()[0][0]) / 2
-long = (filtered_places.features[select_attribute_place][0].get_bounds()[1][1] + filtered_places.features[select_attribute_place][0].get_bounds()[0][1]) / 2
-
-m = folium.Map(tiles="cartodb positron", zoom_start = 12, location=(lat,long))
-fg = folium.FeatureGroup()
-
-for da in filtered_places.features[select_attribute_place]:
-    fg.add_child(da)
-for marker in filtered.features[select_measure]:
-    fg.add_child(marker)
-
-with col1:
-    st_folium(
-        m,
-        feature_group_to_add=fg,
-        returned_objects=[],
-        use_container_width=True
-    )
\ No newline at end of file
+
+    # Map
+    with trace.span("geometry", layer="places") as span:
+        place_geometry = fetches.get("geometry")
+
+        m = folium.Map(tiles="cartodb positron", zoom_start = 12, location=place_geometry.center)
+        tile_server = tiles.server()
+        if tile_server is not None: # The rest of the country around this FSA, as vector tiles
+            national = tile_server.places_layer(select_attribute_place)
+            if national is not None:
+                m.add_child(national)
+        fg = folium.FeatureGroup()
+
+        das = place_geometry.layer(places.data[select_attribute_place], filtered_places.mask, select_attribute_place)
+        fg.add_child(das)
+        for marker in markers:
+            fg.add_child(marker)
+        if trace.enabled:
+            span.set(features=len(das.data["features"]), bytes=len(json.dumps(das.data)))
+
+    with col1, trace.span("map"):
+        st_folium(
+            m,
+            feature_group_to_add=fg,
+            returned_objects=[],
+            use_container_width=True
+        )
+
+    trace.finish(col2a)
+
+facilities_view(select_fsa, select_substance, select_time, select_measure, facilities, places, fetches, trace)
+trace.finish()